@@ -0,0 +1,114 @@
+"""asyncio runtime: ``python async_bot.py``.
+
+Runs the handlers registered in ``bot.py`` on an :class:`AsyncTeleBot`. Each
+handler (and therefore all of its SQLite work) runs on a small dedicated
+executor with its Telegram calls recorded; the calls are then awaited on the
+event loop in the order the handler made them. The event loop itself never
+blocks on SQLite or HTTP, so one process can keep many users in flight.
+"""
+import asyncio
+import inspect
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable
+
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+
+import bot as handlers
+import db
+
+
+logger = logging.getLogger(__name__)
+
+DB_WORKERS = int(os.getenv("DB_WORKERS", "4"))
+
+# Handler lists of the synchronous bot and the AsyncTeleBot method that
+# registers the same kind of handler.
+_REGISTRARS = {
+    "message_handlers": "register_message_handler",
+    "callback_query_handlers": "register_callback_query_handler",
+    "inline_handlers": "register_inline_handler",
+}
+
+abot = AsyncTeleBot(handlers.BOT_TOKEN, parse_mode="HTML")
+executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+
+def _wrap(handler: Callable[[Any], None]) -> Callable[[Any], Awaitable[None]]:
+    async def run(update: Any) -> None:
+        loop = asyncio.get_running_loop()
+        calls = await loop.run_in_executor(executor, handlers.run_recorded, handler, update)
+        for method, args, kwargs in calls:
+            try:
+                await getattr(abot, method)(*args, **kwargs)
+            except Exception as e:
+                not_modified = isinstance(e, ApiTelegramException) and "message is not modified" in str(e)
+                if method == "edit_message_text" and not not_modified:
+                    # edit_message() recorded the new content as sent.
+                    handlers.forget_edit(kwargs.get("chat_id"), kwargs.get("message_id"))
+                if not isinstance(e, ApiTelegramException):
+                    raise
+                logger.warning("%s from %s failed: %s", method, handler.__name__, e)
+
+    run.__name__ = handler.__name__
+    return run
+
+
+_COLD = object()
+
+
+def _may_be_ordering(message: Any) -> bool:
+    # Filters run on the event loop, so this one must not wait for SQLite or
+    # for the state store's lock. States only in the cold tier are let
+    # through; order_step checks them again in the executor.
+    step = handlers.user_states.cached_step(message.from_user.id, cold=_COLD)
+    return step is _COLD or step in handlers._order_steps
+
+
+def register_handlers() -> None:
+    for attr, registrar in _REGISTRARS.items():
+        for handler in getattr(handlers.bot, attr):
+            filters = handler["filters"]
+            if inspect.unwrap(handler["function"]) is handlers.order_step:
+                filters = dict(filters, func=_may_be_ordering)
+            getattr(abot, registrar)(_wrap(handler["function"]), **filters)
+
+
+async def serve() -> None:
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(executor, db.init_db, handlers.DB_PATH)
+    # _may_be_ordering only sees states the store has loaded.
+    await loop.run_in_executor(executor, handlers.user_states.preload)
+    if handlers.CART_WRITE_BEHIND:
+        db.enable_cart_write_behind(
+            handlers.DB_PATH, handlers.CART_FLUSH_MS / 1000, handlers.CART_FLUSH_OPS
+        )
+    await loop.run_in_executor(executor, handlers.broadcaster.resume)
+    try:
+        await abot.infinity_polling()
+    finally:
+        await abot.close_session()
+        await loop.run_in_executor(None, handlers.broadcaster.stop)
+        await loop.run_in_executor(None, handlers.clicks.join, 5.0)
+        await loop.run_in_executor(None, handlers.notifier.stop)
+        db.disable_cart_write_behind(handlers.DB_PATH)
+        executor.shutdown()
+        db.close_connections()
+
+
+def main() -> None:
+    # Before registering, so the AsyncTeleBot gets the timed handlers.
+    # Telegram requests go through aiohttp here and are not timed.
+    metrics_server = handlers.setup_metrics()
+    register_handlers()
+    try:
+        asyncio.run(serve())
+    finally:
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
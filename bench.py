@@ -0,0 +1,375 @@
+"""Offline benchmark of the bot's handlers and db.py.
+
+Replays synthetic user sessions (start, browsing, cart clicks, checkout,
+history) and admin actions (order pages, statistics, export) through the
+real handlers, with Telegram replaced by a local stub, against a temporary
+SQLite database seeded with ``--users`` users and ``--orders`` orders.
+Prints throughput and p50/p95/p99 latencies per handler and per db.py
+function as JSON, for comparison across commits::
+
+    python bench.py --users 10000 --orders 100000 --sessions 500 --threads 4 -o before.json
+"""
+import argparse
+import functools
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+ADMIN_ID = 1
+SEED_BATCH = 1000
+
+Step = Tuple[str, Dict[str, Any]]
+
+
+class Timings:
+    """Latency samples (seconds) and error counts per name."""
+
+    def __init__(self) -> None:
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float, failed: bool = False) -> None:
+        with self._lock:
+            self.samples[name].append(seconds)
+            if failed:
+                self.errors[name] += 1
+
+    def summary(self, wall: Optional[float] = None) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for name in sorted(self.samples):
+            values = sorted(self.samples[name])
+            entry = {
+                "count": len(values),
+                "errors": self.errors.get(name, 0),
+                "mean_ms": sum(values) / len(values) * 1000,
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "max_ms": values[-1] * 1000,
+            }
+            if wall:
+                entry["per_second"] = len(values) / wall
+            result[name] = {k: round(v, 4) for k, v in entry.items()}
+        return result
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of sorted ``values``."""
+    rank = max(1, -(-len(values) * q // 100))
+    return values[int(rank) - 1]
+
+
+# ---------------------------------------------------------------------------
+# Telegram stub
+# ---------------------------------------------------------------------------
+class _Response:
+    status_code = 200
+
+    def __init__(self, result: Any) -> None:
+        self.text = json.dumps({"ok": True, "result": result})
+
+    def json(self) -> Any:
+        return json.loads(self.text)
+
+
+class TelegramStub:
+    """Answers Bot API requests locally, optionally after ``latency`` seconds."""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.calls: Dict[str, int] = defaultdict(int)
+        self._ids = iter(range(1, sys.maxsize))
+        self._lock = threading.Lock()
+
+    def __call__(self, method: str, url: str, params: Optional[Dict[str, Any]] = None, **kwargs: Any) -> _Response:
+        name = url.rsplit("/", 1)[-1]
+        params = params or {}
+        with self._lock:
+            self.calls[name] += 1
+            message_id = next(self._ids)
+        if self.latency:
+            time.sleep(self.latency)
+        if name == "getMe":
+            return _Response({"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"})
+        if name.startswith(("send", "edit")):
+            chat_id = int(params.get("chat_id", 0))
+            return _Response({
+                "message_id": int(params.get("message_id", message_id)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": str(params.get("text", "")),
+            })
+        return _Response(True)
+
+
+# ---------------------------------------------------------------------------
+# Synthetic updates
+# ---------------------------------------------------------------------------
+_update_ids = iter(range(1, sys.maxsize))
+
+
+def _user(user_id: int) -> Dict[str, Any]:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+
+def message(user_id: int, text: str) -> Dict[str, Any]:
+    return {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": next(_update_ids),
+            "from": _user(user_id),
+            "chat": {"id": user_id, "type": "private"},
+            "date": int(time.time()),
+            "text": text,
+        },
+    }
+
+
+def callback(user_id: int, data: str, message_id: int) -> Dict[str, Any]:
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "chat": {"id": user_id, "type": "private"},
+                "date": int(time.time()),
+                "text": "",
+            },
+        },
+    }
+
+
+def user_session(user_id: int, products: List[str], rng: random.Random) -> List[Step]:
+    """One customer: browse, fill the cart, check out, look at the history."""
+    mid = rng.randrange(1, 1 << 30)
+    picks = rng.sample(products, min(len(products), rng.randint(1, 3)))
+    steps: List[Step] = [
+        ("cmd_start", message(user_id, "/start")),
+        ("cb_category", callback(user_id, "cat_0_drugs", mid)),
+        ("cb_category", callback(user_id, "cat_0_subscriptions", mid)),
+    ]
+    for key in picks:
+        steps.append(("cb_view", callback(user_id, f"view_{key}", mid)))
+        for _ in range(rng.randint(1, 3)):
+            steps.append(("cb_add", callback(user_id, f"add_{key}", mid)))
+        if rng.random() < 0.3:
+            steps.append(("cb_remove", callback(user_id, f"remove_{key}", mid)))
+    steps += [
+        ("cb_cart", callback(user_id, "cart", mid)),
+        ("cb_checkout", callback(user_id, "checkout", mid)),
+        ("order_fio", message(user_id, f"Пользователь {user_id}")),
+        ("order_address", message(user_id, "ул. Тестовая, 1")),
+        ("cb_confirm", callback(user_id, "confirm", mid)),
+        ("cmd_history", message(user_id, "/history")),
+        ("cb_my_stats", callback(user_id, "my_stats", mid)),
+        ("cb_main", callback(user_id, "main", mid)),
+    ]
+    return steps
+
+
+def admin_session(rng: random.Random, export: bool) -> List[Step]:
+    mid = rng.randrange(1, 1 << 30)
+    steps: List[Step] = [
+        ("cb_admin", callback(ADMIN_ID, "admin", mid)),
+        ("cb_admin_users", callback(ADMIN_ID, "admin_users", mid)),
+        ("cb_admin_orders", callback(ADMIN_ID, "admin_orders", mid)),
+        ("cmd_orders", message(ADMIN_ID, "/orders min=10000")),
+        ("cb_admin_stats", callback(ADMIN_ID, "admin_stats", mid)),
+    ]
+    if export:
+        steps.append(("cmd_export", message(ADMIN_ID, "/export")))
+    return steps
+
+
+# ---------------------------------------------------------------------------
+# Setup
+# ---------------------------------------------------------------------------
+def seed(db: Any, path: str, users: int, orders: int, rng: random.Random) -> None:
+    """Create ``users`` users with stars and ``orders`` orders spread over them."""
+    db.init_db(path)
+    conn = db._connect(path)
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users(user_id, stars) VALUES (?, ?)",
+            ((user_id, 10 ** 7) for user_id in range(1, users + 1)),
+        )
+    _, _, products = db.load_catalog(path)
+    prices = {p["key"]: p["price"] for p in products}
+    keys = list(prices)
+    for start in range(0, orders, SEED_BATCH):
+        conn.execute("BEGIN")
+        for _ in range(min(SEED_BATCH, orders - start)):
+            items = [(key, rng.randint(1, 3)) for key in rng.sample(keys, rng.randint(1, min(3, len(keys))))]
+            total = sum(prices[key] * qty for key, qty in items)
+            db._insert_order(conn, rng.randint(1, users), items, total, "seed", "seed", prices)
+        conn.commit()
+
+
+def _timed(name: str, fn: Callable[..., Any], timings: Timings) -> Callable[..., Any]:
+    @functools.wraps(fn)
+    def timed(*args: Any, **kwargs: Any) -> Any:
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = fn(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            timings.add(name, time.perf_counter() - started, failed)
+
+    return timed
+
+
+def instrument_db(db: Any, timings: Timings) -> None:
+    """Time every public function of ``db`` called through the module."""
+    for name, fn in list(vars(db).items()):
+        if name.startswith("_") or not callable(fn) or isinstance(fn, type):
+            continue
+        if getattr(fn, "__module__", None) != db.__name__:
+            continue
+        setattr(db, name, _timed(name, fn, timings))
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=1000, help="users to seed")
+    parser.add_argument("--orders", type=int, default=10000, help="orders to seed")
+    parser.add_argument("--sessions", type=int, default=200, help="customer sessions to replay")
+    parser.add_argument("--admin-every", type=int, default=20, help="one admin session per N customer sessions (0: none)")
+    parser.add_argument("--threads", type=int, default=1, help="sessions replayed concurrently")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="simulated Telegram API latency")
+    parser.add_argument("--no-export", action="store_true", help="leave /export out of admin sessions")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    path = os.path.join(workdir, "bench.db")
+    # Settings are read when bot.py is imported. Clicks are applied one by
+    # one unless the environment asks for coalescing explicitly.
+    os.environ.update({"BOT_TOKEN": "1:bench", "DB_PATH": path, "ADMIN_IDS": str(ADMIN_ID)})
+    os.environ.setdefault("CLICK_WINDOW_MS", "0")
+    os.environ.setdefault("CHAT_RATE", "1000000")
+    os.environ.setdefault("CHAT_BURST", "1000000")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        from telebot import apihelper, types
+
+        stub = TelegramStub(args.api_latency_ms / 1000)
+        apihelper.CUSTOM_REQUEST_SENDER = stub
+
+        import db
+        import bot
+
+        rng = random.Random(args.seed)
+        started = time.perf_counter()
+        seed(db, path, args.users, args.orders, rng)
+        seed_seconds = time.perf_counter() - started
+        bot.catalog.reload()
+        if bot.CART_WRITE_BEHIND:
+            db.enable_cart_write_behind(path, bot.CART_FLUSH_MS / 1000, bot.CART_FLUSH_OPS)
+        bot.bot.threaded = False
+
+        products = [p["key"] for c in bot.catalog.categories() for p in bot.catalog.in_category(c["key"])]
+        sessions: List[List[Step]] = []
+        for number in range(args.sessions):
+            user_id = rng.randint(2, max(2, args.users))
+            sessions.append(user_session(user_id, products, rng))
+            if args.admin_every and number % args.admin_every == 0:
+                sessions.append(admin_session(rng, not args.no_export))
+
+        db_timings = Timings()
+        instrument_db(db, db_timings)
+        handler_timings = Timings()
+
+        def replay(steps: List[Step]) -> None:
+            for name, data in steps:
+                update = types.Update.de_json(data)
+                t0 = time.perf_counter()
+                failed = False
+                try:
+                    bot.bot.process_new_updates([update])
+                except Exception:
+                    failed = True
+                handler_timings.add(name, time.perf_counter() - t0, failed)
+
+        updates = sum(len(s) for s in sessions)
+        started = time.perf_counter()
+        if args.threads > 1:
+            with ThreadPoolExecutor(args.threads) as pool:
+                list(pool.map(replay, sessions))
+        else:
+            for steps in sessions:
+                replay(steps)
+        wall = time.perf_counter() - started
+        bot.notifier.stop()
+        db.disable_cart_write_behind(path)
+
+        report = {
+            "meta": {
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "args": vars(args),
+                "env": {k: os.environ[k] for k in ("CART_WRITE_BEHIND", "CART_CACHE_SIZE", "CLICK_WINDOW_MS") if k in os.environ},
+                "seed_seconds": round(seed_seconds, 3),
+            },
+            "total": {
+                "updates": updates,
+                "seconds": round(wall, 4),
+                "updates_per_second": round(updates / wall, 2) if wall else None,
+                "api_calls": dict(stub.calls),
+            },
+            "handlers": handler_timings.summary(wall),
+            "db": db_timings.summary(wall),
+        }
+        db.close_connections()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    for section in ("handlers", "db"):
+        print(f"\n{section:<28} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}", file=sys.stderr)
+        for name, s in report[section].items():
+            print(f"{name:<28} {s['count']:>7} {s['p50_ms']:>9.3f} {s['p95_ms']:>9.3f} {s['p99_ms']:>9.3f}", file=sys.stderr)
+    print(f"\n{updates} updates in {wall:.2f} s ({updates / wall:.0f}/s)", file=sys.stderr)
+    return report
+
+
+if __name__ == "__main__":
+    main()
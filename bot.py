@@ -1,12 +1,30 @@
 import os
 import logging
-from typing import Dict
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from html import escape
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 
 from dotenv import load_dotenv
 import telebot
 from telebot import types
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
 
+import broadcast
 import db
+import metrics
+import notify
+import throttle
+import webhook
+from catalog import Catalog
+from router import CallbackRouter
+from state import StateStore
+import catalog as catalog_module
+import state as state_module
 
 
 load_dotenv()
@@ -14,9 +32,39 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "").split(',') if x]
 DB_PATH = os.getenv("DB_PATH", db.DB_PATH)
+CART_WRITE_BEHIND = os.getenv("CART_WRITE_BEHIND", "0") == "1"
+CART_FLUSH_MS = int(os.getenv("CART_FLUSH_MS", "5"))
+CART_FLUSH_OPS = int(os.getenv("CART_FLUSH_OPS", "256"))
+EXPORT_COMPRESS = os.getenv("EXPORT_COMPRESS", "0") == "1"
+CART_CACHE_SIZE = int(os.getenv("CART_CACHE_SIZE", str(db.CART_CACHE_SIZE)))
+NOTIFY_DIGEST_SECONDS = float(os.getenv("NOTIFY_DIGEST_SECONDS", str(notify.DIGEST_INTERVAL)))
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", str(notify.QUEUE_SIZE)))
+CATALOG_REFRESH_SECONDS = float(os.getenv("CATALOG_REFRESH_SECONDS", str(catalog_module.REFRESH_INTERVAL)))
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", str(catalog_module.PAGE_SIZE)))
+STATE_TTL_SECONDS = float(os.getenv("STATE_TTL_SECONDS", str(state_module.TTL)))
+STATE_MAX_HOT = int(os.getenv("STATE_MAX_HOT", str(state_module.MAX_HOT)))
+STATE_MAX_COLD = int(os.getenv("STATE_MAX_COLD", str(state_module.MAX_COLD)))
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT") or "8080")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(webhook.WORKERS)))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", str(webhook.QUEUE_SIZE)))
+CLICK_WINDOW_MS = int(os.getenv("CLICK_WINDOW_MS", str(int(throttle.WINDOW * 1000))))
+CHAT_RATE = float(os.getenv("CHAT_RATE", str(throttle.CHAT_RATE)))
+CHAT_BURST = float(os.getenv("CHAT_BURST", str(throttle.CHAT_BURST)))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", str(broadcast.RATE)))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", str(broadcast.WORKERS)))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PROFILE_SLOW_MS = float(os.getenv("METRICS_PROFILE_SLOW_MS", "0"))
 
 logging.basicConfig(level=logging.INFO)
 
+db.configure_cart_cache(CART_CACHE_SIZE)
+
 if not BOT_TOKEN:
     raise RuntimeError(
         "BOT_TOKEN is not set. Create a .env file based on .env.example and "
@@ -24,37 +72,71 @@ if not BOT_TOKEN:
     )
 
 bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+notifier = notify.NotificationDispatcher(
+    bot.send_message,
+    ADMIN_IDS,
+    digest_interval=NOTIFY_DIGEST_SECONDS,
+    max_queue=NOTIFY_QUEUE_SIZE,
+)
+broadcaster = broadcast.Broadcaster(
+    bot.send_message,
+    bot.send_message,
+    DB_PATH,
+    rate=BROADCAST_RATE,
+    workers=BROADCAST_WORKERS,
+)
+
+
+# ---------------------------------------------------------------------------
+# Telegram client used by handlers
+# ---------------------------------------------------------------------------
+ApiCall = Tuple[str, Tuple[Any, ...], Dict[str, Any]]
+
+
+class _Outbox:
+    """Records Telegram API calls instead of sending them."""
+
+    def __init__(self) -> None:
+        self.calls: List[ApiCall] = []
+
+    def __getattr__(self, method: str) -> Callable[..., None]:
+        def record(*args: Any, **kwargs: Any) -> None:
+            self.calls.append((method, args, kwargs))
+
+        return record
+
+
+class _Api:
+    """Sends through ``bot`` unless the current thread is recording.
+
+    Handlers call Telegram through ``api`` so that other runtimes (see
+    ``async_bot.py``) can run them unchanged and perform the calls themselves.
+    """
+
+    def __getattr__(self, method: str) -> Any:
+        outbox = getattr(_recording, "outbox", None)
+        return getattr(outbox if outbox is not None else bot, method)
+
+
+_recording = threading.local()
+api = _Api()
+
+
+def run_recorded(handler: Callable[[Any], None], update: Any) -> List[ApiCall]:
+    """Run ``handler`` and return the API calls it made, in order, unsent."""
+    outbox = _Outbox()
+    _recording.outbox = outbox
+    try:
+        handler(update)
+    finally:
+        _recording.outbox = None
+    return outbox.calls
 
 
 # ---------------------------------------------------------------------------
 # Data
 # ---------------------------------------------------------------------------
-drugs: Dict[str, Dict[str, object]] = {
-    "ragvizax": {
-        "name": "Рагвизакс",
-        "desc": "\U0001F33C АСИТ-препарат против аллергии на амброзию.",
-        "price": 11300,
-        "emoji": "\U0001F33C",
-    },
-    "grazax": {
-        "name": "Гразакс",
-        "desc": "\U0001F33F АСИТ-препарат от злаковых трав.",
-        "price": 8300,
-        "emoji": "\U0001F33F",
-    },
-    "ragvizax_year": {
-        "name": "Подписка на Рагвизакс",
-        "desc": "\U0001F4E6 Подписка на 1 год на курс АСИТ.",
-        "price": 110000,
-        "emoji": "\U0001F4E6",
-    },
-    "grazax_year": {
-        "name": "Подписка на Гразакс",
-        "desc": "\U0001F4E6 Подписка на 1 год на курс лечения.",
-        "price": 90000,
-        "emoji": "\U0001F4E6",
-    },
-}
+catalog = Catalog(DB_PATH, refresh_interval=CATALOG_REFRESH_SECONDS)
 
 
 # ---------------------------------------------------------------------------
@@ -64,78 +146,295 @@ def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
 
-def notify_admins(text: str) -> None:
-    for admin_id in ADMIN_IDS:
-        try:
-            bot.send_message(admin_id, text)
-        except Exception:
-            continue
+def is_product(key: str) -> bool:
+    return key in catalog
+
+
+def is_page(arg: str) -> bool:
+    return arg == "" or arg.isdigit()
+
+
+def is_category_page(arg: str) -> bool:
+    page, _, category = arg.partition("_")
+    return page.isdigit() and catalog.category(category) is not None
+
+
+def is_cursor(arg: str) -> bool:
+    """Keyset cursor in callback data: ``a<id>`` (after) or ``b<id>`` (before)."""
+    return arg == "" or (arg[:1] in ("a", "b") and arg[1:].isdigit())
+
+
+def parse_cursor(arg: str) -> Tuple[Optional[int], Optional[int]]:
+    """Split a cursor into the ``(after, before)`` arguments of a page query."""
+    if not arg:
+        return None, None
+    value = int(arg[1:])
+    return (value, None) if arg[0] == "a" else (None, value)
+
+
+def available(items: List[Tuple[str, int]]) -> List[Tuple[str, int]]:
+    """Cart lines whose product is still in the catalog."""
+    return [(k, q) for k, q in items if k in catalog]
+
+
+def notify_admins(text: str, digest: bool = False) -> None:
+    """Queue a message for all admins; ``digest`` ones are batched."""
+    notifier.submit(text, digest=digest)
+
+
+# Fingerprints of the last content sent to each message, so that an edit that
+# would not change anything is not sent at all.
+_EDITED_MAX = 10000
+_edited: "OrderedDict[Tuple[int, int], int]" = OrderedDict()
+_edited_lock = threading.Lock()
+
+
+def edit_message(chat_id: int, message_id: int, text: str, reply_markup: Any = None) -> None:
+    """Edit a message unless it already shows ``text`` and ``reply_markup``."""
+    key = (chat_id, message_id)
+    fingerprint = hash((text, reply_markup))
+    with _edited_lock:
+        if _edited.get(key) == fingerprint:
+            _edited.move_to_end(key)
+            return
+        _edited[key] = fingerprint
+        _edited.move_to_end(key)
+        if len(_edited) > _EDITED_MAX:
+            _edited.popitem(last=False)
+    try:
+        api.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+    except Exception as exc:
+        if isinstance(exc, ApiTelegramException) and "message is not modified" in str(exc):
+            return
+        forget_edit(chat_id, message_id)
+        raise
+
+
+def forget_edit(chat_id: int, message_id: int) -> None:
+    """Drop the fingerprint of an edit that did not reach Telegram."""
+    with _edited_lock:
+        _edited.pop((chat_id, message_id), None)
+
+
+def edit(call: types.CallbackQuery, text: str, reply_markup: Any = None) -> None:
+    # The message now shows another screen; a queued +/- redraw would
+    # replace it with the product again.
+    clicks.discard((call.from_user.id, call.message.chat.id, call.message.message_id))
+    edit_message(call.message.chat.id, call.message.message_id, text, reply_markup)
+
+
+# ---------------------------------------------------------------------------
+# Render cache
+# ---------------------------------------------------------------------------
+class _RenderCache:
+    """Bounded LRU of rendered texts and serialized keyboards.
+
+    Entries are only valid for the catalog version they were built for; the
+    whole cache is dropped as soon as ``catalog.version`` changes.
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple[Any, ...], Any]" = OrderedDict()
+        self._version = -1
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[Any, ...], build: Callable[[], Any]) -> Any:
+        current = catalog.version
+        with self._lock:
+            if self._version != current:
+                self._entries.clear()
+                self._version = current
+            value = self._entries.get(key)
+            if value is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return value
+            self.misses += 1
+            version = self._version
+        value = build()
+        with self._lock:
+            if version == self._version:
+                self._entries[key] = value
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+
+RENDER_CACHE_SIZE = 1024
+render_cache = _RenderCache(RENDER_CACHE_SIZE)
 
 
 # ---------------------------------------------------------------------------
 # Keyboards
 # ---------------------------------------------------------------------------
-def main_menu(user_id: int) -> types.InlineKeyboardMarkup:
+# Keyboards are returned as serialized markup (TeleBot sends strings as is),
+# so cached screens cost neither rebuilding nor re-serializing.
+def _build_main_menu(admin: bool) -> str:
     kb = types.InlineKeyboardMarkup()
-    kb.row(types.InlineKeyboardButton("\U0001F48A Препараты", callback_data="drugs"))
+    # One button per category that has something on sale, in catalog order.
+    for category in catalog.categories():
+        if catalog.in_category(category["key"]):
+            kb.row(types.InlineKeyboardButton(category["title"], callback_data=f"cat_0_{category['key']}"))
     kb.row(types.InlineKeyboardButton("\U0001F4C8 Моя статистика", callback_data="my_stats"))
-    kb.row(types.InlineKeyboardButton("\U0001F4E6 Подписки", callback_data="subscriptions"))
     kb.row(types.InlineKeyboardButton("\U0001F6D2 Корзина", callback_data="cart"))
-    if is_admin(user_id):
+    if admin:
         kb.row(types.InlineKeyboardButton("\U0001F465 Админ", callback_data="admin"))
-    return kb
+    return kb.to_json()
 
 
-def drugs_keyboard() -> types.InlineKeyboardMarkup:
-    kb = types.InlineKeyboardMarkup()
-    for key, item in drugs.items():
-        if key.endswith("_year"):
-            continue
-        kb.add(types.InlineKeyboardButton(f"{item['emoji']} {item['name']} — {item['price']} ⭐", callback_data=f"view_{key}"))
-    kb.add(types.InlineKeyboardButton("\U0001F519 Назад", callback_data="main"))
-    return kb
+def main_menu(user_id: int) -> str:
+    admin = is_admin(user_id)
+    return render_cache.get(("main_menu", admin), lambda: _build_main_menu(admin))
 
 
-def subs_keyboard() -> types.InlineKeyboardMarkup:
+def _build_category_keyboard(category: str, page: int) -> str:
     kb = types.InlineKeyboardMarkup()
-    for key, item in drugs.items():
-        if key.endswith("_year"):
-            kb.add(types.InlineKeyboardButton(f"{item['emoji']} {item['name']} — {item['price']} ⭐", callback_data=f"view_{key}"))
+    items, pages = catalog.page(category, page, CATALOG_PAGE_SIZE)
+    for item in items:
+        kb.add(types.InlineKeyboardButton(f"{item['emoji']} {item['name']} — {item['price']} ⭐", callback_data=f"view_{item['key']}"))
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(types.InlineKeyboardButton("\u2B05\uFE0F", callback_data=f"cat_{page - 1}_{category}"))
+        if page < pages - 1:
+            nav.append(types.InlineKeyboardButton("\u27A1\uFE0F", callback_data=f"cat_{page + 1}_{category}"))
+        kb.row(*nav)
     kb.add(types.InlineKeyboardButton("\U0001F519 Назад", callback_data="main"))
-    return kb
+    return kb.to_json()
 
 
-def drug_detail_keyboard(drug_id: str, count: int) -> types.InlineKeyboardMarkup:
+def category_keyboard(category: str, page: int = 0) -> str:
+    return render_cache.get(
+        ("category", category, page), lambda: _build_category_keyboard(category, page)
+    )
+
+
+def _build_drug_detail_keyboard(drug_id: str, in_cart: bool) -> str:
     kb = types.InlineKeyboardMarkup()
-    if count > 0:
+    if in_cart:
         kb.add(types.InlineKeyboardButton("\u2795 Добавить", callback_data=f"add_{drug_id}"))
         kb.add(types.InlineKeyboardButton("\u2796 Удалить", callback_data=f"remove_{drug_id}"))
     else:
         kb.add(types.InlineKeyboardButton("\u2795 Добавить", callback_data=f"add_{drug_id}"))
     kb.add(types.InlineKeyboardButton("\U0001F6D2 Корзина", callback_data="cart"))
-    return kb
+    return kb.to_json()
+
+
+def drug_detail_keyboard(drug_id: str, count: int) -> str:
+    in_cart = count > 0
+    return render_cache.get(
+        ("detail_kb", drug_id, in_cart), lambda: _build_drug_detail_keyboard(drug_id, in_cart)
+    )
+
 
+def drug_detail_text(drug_id: str, count: int) -> str:
+    def build() -> str:
+        d = catalog[drug_id]
+        return f"{escape(d['emoji'])} <b>{escape(d['name'])}</b>\n\n{escape(d['desc'])}\nСтоимость: {d['price']} ⭐\nВ корзине: "
 
-def cart_keyboard(items: Dict[str, int]) -> types.InlineKeyboardMarkup:
+    return render_cache.get(("detail_text", drug_id), build) + str(count)
+
+
+def _build_cart_keyboard(drug_ids: Tuple[str, ...]) -> str:
     kb = types.InlineKeyboardMarkup()
-    for drug_id in items:
-        kb.add(types.InlineKeyboardButton(f"\u274C Удалить {drugs[drug_id]['name']}", callback_data=f"remove_{drug_id}"))
-    if items:
+    for drug_id in drug_ids:
+        kb.add(types.InlineKeyboardButton(f"\u274C Удалить {catalog[drug_id]['name']}", callback_data=f"remove_{drug_id}"))
+    if drug_ids:
         kb.add(types.InlineKeyboardButton("\U0001F4B3 Оформить", callback_data="checkout"))
         kb.add(types.InlineKeyboardButton("\U0001F5D1 Очистить", callback_data="clear_cart"))
     kb.add(types.InlineKeyboardButton("\U0001F519 Назад", callback_data="main"))
-    return kb
+    return kb.to_json()
+
+
+def cart_keyboard(items: Dict[str, int]) -> str:
+    drug_ids = tuple(items)
+    return render_cache.get(("cart_kb", drug_ids), lambda: _build_cart_keyboard(drug_ids))
+
+
+def _build_confirm_keyboard() -> str:
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("Да", callback_data="confirm"))
+    kb.add(types.InlineKeyboardButton("Отмена", callback_data="cancel"))
+    return kb.to_json()
+
+
+def confirm_keyboard() -> str:
+    return render_cache.get(("confirm",), _build_confirm_keyboard)
+
+
+def _build_admin_keyboard() -> str:
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("Пользователи", callback_data="admin_users"))
+    kb.add(types.InlineKeyboardButton("Заказы", callback_data="admin_orders"))
+    kb.add(types.InlineKeyboardButton("\U0001F4CA Статистика", callback_data="admin_stats"))
+    kb.add(types.InlineKeyboardButton("Выгрузка заказов (CSV)", callback_data="admin_csv"))
+    kb.add(types.InlineKeyboardButton("Назад", callback_data="main"))
+    return kb.to_json()
+
+
+def admin_keyboard() -> str:
+    return render_cache.get(("admin",), _build_admin_keyboard)
+
+
+def page_keyboard(action: str, page: db.Page, suffix: str = "", back: str = "admin") -> str:
+    """Navigation for a keyset page; ``suffix`` is carried along in callback data."""
+    kb = types.InlineKeyboardMarkup()
+    nav = []
+    if page.prev is not None:
+        nav.append(types.InlineKeyboardButton("\u2B05\uFE0F", callback_data=f"{action}_b{page.prev}{suffix}"))
+    if page.next is not None:
+        nav.append(types.InlineKeyboardButton("\u27A1\uFE0F", callback_data=f"{action}_a{page.next}{suffix}"))
+    if nav:
+        kb.row(*nav)
+    kb.add(types.InlineKeyboardButton("Назад", callback_data=back))
+    return kb.to_json()
+
+
+def _build_my_stats_keyboard() -> str:
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("\U0001F9FE История заказов", callback_data="history"))
+    kb.add(types.InlineKeyboardButton("\U0001F519 Назад", callback_data="main"))
+    return kb.to_json()
+
+
+def my_stats_keyboard() -> str:
+    return render_cache.get(("my_stats",), _build_my_stats_keyboard)
+
+
+def _build_back_keyboard(target: str) -> str:
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("Назад", callback_data=target))
+    return kb.to_json()
+
+
+def back_keyboard(target: str) -> str:
+    return render_cache.get(("back", target), lambda: _build_back_keyboard(target))
 
 
 # ---------------------------------------------------------------------------
 # States
 # ---------------------------------------------------------------------------
-user_states: Dict[int, Dict[str, str]] = {}
+user_states = StateStore(
+    DB_PATH, ttl=STATE_TTL_SECONDS, max_hot=STATE_MAX_HOT, max_cold=STATE_MAX_COLD
+)
 
 
 # ---------------------------------------------------------------------------
 # Handlers
 # ---------------------------------------------------------------------------
+router = CallbackRouter()
+STALE_BUTTON = "Кнопка устарела, откройте меню заново"
+
+
+@bot.callback_query_handler(func=lambda c: True)
+def on_callback(call: types.CallbackQuery) -> None:
+    if not router.dispatch(call):
+        api.answer_callback_query(call.id, STALE_BUTTON)
+
+
 @bot.message_handler(commands=["start"])
 def cmd_start(message: types.Message) -> None:
     db.init_db(DB_PATH)
@@ -144,171 +443,250 @@ def cmd_start(message: types.Message) -> None:
     stars = db.get_stars(message.from_user.id, DB_PATH)
     if stars == 0:
         db.update_stars(message.from_user.id, 100000, DB_PATH)
-    bot.send_message(
+    api.send_message(
         message.chat.id,
         "\U0001F44B Добро пожаловать в аптеку ДОКТОР - ВРАЧ!",
         reply_markup=main_menu(message.from_user.id),
     )
+    # Deep link from an inline search result: /start view_<key>
+    payload = message.text.split(maxsplit=1)[1] if " " in message.text else ""
+    if payload.startswith("view_") and payload[5:] in catalog:
+        drug_id = payload[5:]
+        count = dict(db.get_cart(message.from_user.id, DB_PATH)).get(drug_id, 0)
+        api.send_message(message.chat.id, drug_detail_text(drug_id, count), reply_markup=drug_detail_keyboard(drug_id, count))
+
+
+@router.callback("main")
+def cb_main(call: types.CallbackQuery, arg: str) -> None:
+    edit(call, "\U0001F3E0 Главное меню:", main_menu(call.from_user.id))
+    api.answer_callback_query(call.id)
+
 
+def show_category(call: types.CallbackQuery, category: str, page: int) -> None:
+    title = (catalog.category(category) or {}).get("title", category)
+    edit(call, f"{escape(title)}:", category_keyboard(category, page))
+    api.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda c: c.data == "main")
-def cb_main(call: types.CallbackQuery) -> None:
-    bot.edit_message_text("\U0001F3E0 Главное меню:", chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=main_menu(call.from_user.id))
-    bot.answer_callback_query(call.id)
 
+@router.callback("cat", prefix=True, validate=is_category_page)
+def cb_category(call: types.CallbackQuery, arg: str) -> None:
+    page, category = arg.split("_", 1)
+    show_category(call, category, int(page))
 
-@bot.callback_query_handler(func=lambda c: c.data == "drugs")
-def cb_drugs(call: types.CallbackQuery) -> None:
-    bot.edit_message_text("\U0001F48A Препараты:", chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=drugs_keyboard())
-    bot.answer_callback_query(call.id)
 
+# Buttons of the fixed menu that preceded categories; old messages still
+# carry them.
+@router.callback("drugs", prefix=True, validate=is_page)
+def cb_drugs(call: types.CallbackQuery, page: str) -> None:
+    show_category(call, "drugs", int(page or 0))
 
-@bot.callback_query_handler(func=lambda c: c.data == "subscriptions")
-def cb_subs(call: types.CallbackQuery) -> None:
-    bot.edit_message_text("\U0001F4E6 Подписки:", chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=subs_keyboard())
-    bot.answer_callback_query(call.id)
 
+@router.callback("subscriptions", prefix=True, validate=is_page)
+def cb_subs(call: types.CallbackQuery, page: str) -> None:
+    show_category(call, "subscriptions", int(page or 0))
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("view_"))
-def cb_view(call: types.CallbackQuery) -> None:
-    drug_id = call.data.split("_", 1)[1]
+
+@router.callback("view", prefix=True, validate=is_product)
+def cb_view(call: types.CallbackQuery, drug_id: str) -> None:
     items = dict(db.get_cart(call.from_user.id, DB_PATH))
     count = items.get(drug_id, 0)
-    d = drugs[drug_id]
-    text = f"{d['emoji']} <b>{d['name']}</b>\n\n{d['desc']}\nСтоимость: {d['price']} ⭐\nВ корзине: {count}"
-    bot.edit_message_text(text, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=drug_detail_keyboard(drug_id, count))
-    bot.answer_callback_query(call.id)
+    text = drug_detail_text(drug_id, count)
+    edit(call, text, drug_detail_keyboard(drug_id, count))
+    api.answer_callback_query(call.id)
+
+
+def _flush_clicks(key: Tuple[int, int, int], events: List[str]) -> None:
+    """Redraw a product message once for a burst of +/- presses on it."""
+    user_id, chat_id, message_id = key
+    drug_id = events[-1]
+    if drug_id in catalog:
+        count = dict(db.get_cart(user_id, DB_PATH)).get(drug_id, 0)
+        edit_message(chat_id, message_id, drug_detail_text(drug_id, count), drug_detail_keyboard(drug_id, count))
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("add_"))
-def cb_add(call: types.CallbackQuery) -> None:
-    drug_id = call.data.split("_", 1)[1]
+def _click_delay(key: Tuple[int, int, int]) -> float:
+    return chat_limiter.delay(key[1])
+
+
+chat_limiter = throttle.ChatRateLimiter(CHAT_RATE, CHAT_BURST)
+clicks = throttle.Coalescer(_flush_clicks, CLICK_WINDOW_MS / 1000, delay=_click_delay)
+
+
+def _push_click(call: types.CallbackQuery, drug_id: str) -> None:
+    # The cart is already changed; only the redraw waits for the burst to
+    # end and for the chat's rate limit.
+    api.answer_callback_query(call.id)
+    key = (call.from_user.id, call.message.chat.id, call.message.message_id)
+    clicks.push(key, drug_id)
+
+
+@router.callback("add", prefix=True, validate=is_product)
+def cb_add(call: types.CallbackQuery, drug_id: str) -> None:
     db.add_to_cart(call.from_user.id, drug_id, path=DB_PATH)
-    notify_admins(f"Пользователь {call.from_user.id} добавил {drugs[drug_id]['name']}")
-    cb_view(call)
+    product = catalog.get(drug_id)
+    if product is not None:
+        notify_admins(f"Пользователь {call.from_user.id} добавил {escape(product['name'])}", digest=True)
+    _push_click(call, drug_id)
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("remove_"))
-def cb_remove(call: types.CallbackQuery) -> None:
-    drug_id = call.data.split("_", 1)[1]
+@router.callback("remove", prefix=True, validate=is_product)
+def cb_remove(call: types.CallbackQuery, drug_id: str) -> None:
     db.remove_from_cart(call.from_user.id, drug_id, path=DB_PATH)
-    cb_view(call)
+    _push_click(call, drug_id)
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "cart")
-def cb_cart(call: types.CallbackQuery) -> None:
-    items = dict(db.get_cart(call.from_user.id, DB_PATH))
+@router.callback("cart")
+def cb_cart(call: types.CallbackQuery, arg: str) -> None:
+    items = dict(available(db.get_cart(call.from_user.id, DB_PATH)))
     if not items:
-        bot.edit_message_text("\U0001F6D2 Корзина пуста", chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=main_menu(call.from_user.id))
+        edit(call, "\U0001F6D2 Корзина пуста", main_menu(call.from_user.id))
         return
     text = "\U0001F6D2 Корзина:\n\n"
     total = 0
     for key, qty in items.items():
-        total += drugs[key]["price"] * qty
-        text += f"{drugs[key]['emoji']} {drugs[key]['name']} × {qty} = {drugs[key]['price'] * qty} ⭐\n"
+        d = catalog[key]
+        total += d["price"] * qty
+        text += f"{escape(d['emoji'])} {escape(d['name'])} × {qty} = {d['price'] * qty} ⭐\n"
     text += f"\nВсего: <b>{total}</b> ⭐"
-    bot.edit_message_text(text, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=cart_keyboard(items))
-    bot.answer_callback_query(call.id)
+    edit(call, text, cart_keyboard(items))
+    api.answer_callback_query(call.id)
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "clear_cart")
-def cb_clear_cart(call: types.CallbackQuery) -> None:
+@router.callback("clear_cart")
+def cb_clear_cart(call: types.CallbackQuery, arg: str) -> None:
     db.clear_cart(call.from_user.id, DB_PATH)
-    bot.edit_message_text("\U0001F5D1 Корзина очищена", chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=main_menu(call.from_user.id))
-    bot.answer_callback_query(call.id)
+    edit(call, "\U0001F5D1 Корзина очищена", main_menu(call.from_user.id))
+    api.answer_callback_query(call.id)
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "checkout")
-def cb_checkout(call: types.CallbackQuery) -> None:
+@router.callback("checkout")
+def cb_checkout(call: types.CallbackQuery, arg: str) -> None:
     items = db.get_cart(call.from_user.id, DB_PATH)
     if not items:
-        bot.answer_callback_query(call.id, "Корзина пуста", show_alert=True)
+        api.answer_callback_query(call.id, "Корзина пуста", show_alert=True)
         return
-    user_states[call.from_user.id] = {"step": "fio"}
-    bot.send_message(call.from_user.id, "Введите ФИО")
-    bot.answer_callback_query(call.id)
+    user_states.set(call.from_user.id, {"step": "fio"})
+    api.send_message(call.from_user.id, "Введите ФИО")
+    api.answer_callback_query(call.id)
 
 
-@bot.message_handler(func=lambda m: user_states.get(m.from_user.id, {}).get("step") == "fio")
-def order_fio(message: types.Message) -> None:
-    state = user_states.get(message.from_user.id, {})
+def order_fio(message: types.Message, state: Dict[str, object]) -> None:
     state["fio"] = message.text
     state["step"] = "address"
-    user_states[message.from_user.id] = state
-    bot.send_message(message.chat.id, "Введите адрес доставки")
+    user_states.set(message.from_user.id, state)
+    api.send_message(message.chat.id, "Введите адрес доставки")
 
 
-@bot.message_handler(func=lambda m: user_states.get(m.from_user.id, {}).get("step") == "address")
-def order_address(message: types.Message) -> None:
-    state = user_states.get(message.from_user.id, {})
+def order_address(message: types.Message, state: Dict[str, object]) -> None:
     state["address"] = message.text
-    items = db.get_cart(message.from_user.id, DB_PATH)
-    total = sum(drugs[k]["price"] * q for k, q in items)
-    lines = [f"{drugs[k]['name']} × {q}" for k, q in items]
+    items = available(db.get_cart(message.from_user.id, DB_PATH))
+    total = sum(catalog[k]["price"] * q for k, q in items)
+    lines = [f"{escape(catalog[k]['name'])} × {q}" for k, q in items]
     text = (
         f"Подтверждаете заказ?\n"
         f"Товары: {', '.join(lines)}\n"
         f"Сумма: {total} ⭐\n"
-        f"ФИО: {state['fio']}\n"
-        f"Адрес: {state['address']}"
+        f"ФИО: {escape(state['fio'])}\n"
+        f"Адрес: {escape(state['address'])}"
     )
-    kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton("Да", callback_data="confirm"))
-    kb.add(types.InlineKeyboardButton("Отмена", callback_data="cancel"))
     state["step"] = "confirm"
-    user_states[message.from_user.id] = state
-    bot.send_message(message.chat.id, text, reply_markup=kb)
+    user_states.set(message.from_user.id, state)
+    api.send_message(message.chat.id, text, reply_markup=confirm_keyboard())
+
+
+_order_steps: Dict[object, Callable[[types.Message, Dict[str, object]], None]] = {
+    "fio": order_fio,
+    "address": order_address,
+}
 
 
-@bot.callback_query_handler(func=lambda c: c.data in {"confirm", "cancel"})
-def cb_confirm(call: types.CallbackQuery) -> None:
+@bot.message_handler(func=lambda m: user_states.step(m.from_user.id) in _order_steps)
+def order_step(message: types.Message) -> None:
+    state = user_states.get(message.from_user.id)
+    if state is None or state.get("step") not in _order_steps:
+        return
+    _order_steps[state["step"]](message, state)
+
+
+@router.callback("confirm")
+@router.callback("cancel")
+def cb_confirm(call: types.CallbackQuery, arg: str) -> None:
     state = user_states.get(call.from_user.id)
-    if not state:
-        bot.answer_callback_query(call.id)
+    # Buttons of an earlier checkout stay in the chat after it was finished
+    # or restarted.
+    if not state or state.get("step") != "confirm":
+        api.answer_callback_query(call.id, STALE_BUTTON)
         return
     if call.data == "cancel":
-        user_states.pop(call.from_user.id, None)
-        bot.edit_message_text("Заказ отменён", chat_id=call.message.chat.id, message_id=call.message.message_id)
-        bot.answer_callback_query(call.id)
+        user_states.pop(call.from_user.id)
+        edit(call, "Заказ отменён")
+        api.answer_callback_query(call.id)
         return
-    items = db.get_cart(call.from_user.id, DB_PATH)
-    total = sum(drugs[k]["price"] * q for k, q in items)
-    stars = db.get_stars(call.from_user.id, DB_PATH)
-    if stars < total:
-        bot.edit_message_text(
-            f"\u274C Недостаточно звёзд\nУ вас: {stars} ⭐\nНужно: {total} ⭐",
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-        )
-        user_states.pop(call.from_user.id, None)
-        bot.answer_callback_query(call.id)
-        return
-    db.update_stars(call.from_user.id, -total, DB_PATH)
-    db.create_order(call.from_user.id, items, total, state["fio"], state["address"], DB_PATH)
-    user_states.pop(call.from_user.id, None)
-    bot.edit_message_text(
-        "\u2705 Заказ успешно оформлен!\nСпасибо за покупку!",
-        chat_id=call.message.chat.id,
-        message_id=call.message.message_id,
-    )
-    notify_admins(f"Пользователь {call.from_user.id} оформил заказ на {total} ⭐")
-    bot.answer_callback_query(call.id)
+    result = db.checkout(call.from_user.id, state["fio"], state["address"], DB_PATH)
+    user_states.pop(call.from_user.id)
+    if result.status == db.CHECKOUT_EMPTY:
+        edit(call, "\U0001F6D2 Корзина пуста")
+        api.answer_callback_query(call.id)
+        return
+    if result.status == db.CHECKOUT_INSUFFICIENT:
+        edit(call, f"\u274C Недостаточно звёзд\nУ вас: {result.stars} ⭐\nНужно: {result.total} ⭐")
+        api.answer_callback_query(call.id)
+        return
+    edit(call, "\u2705 Заказ успешно оформлен!\nСпасибо за покупку!")
+    notify_admins(f"Пользователь {call.from_user.id} оформил заказ на {result.total} ⭐")
+    api.answer_callback_query(call.id)
 
 
 @bot.message_handler(commands=["stars"])
 def cmd_stars(message: types.Message) -> None:
     stars = db.get_stars(message.from_user.id, DB_PATH)
-    bot.send_message(message.chat.id, f"У вас {stars} ⭐")
+    api.send_message(message.chat.id, f"У вас {stars} ⭐")
+
+
+def _format_time(created_at: Optional[str]) -> str:
+    return created_at[:16].replace("T", " ") if created_at else "—"
+
+
+def history_screen(user_id: int, cursor: str = "") -> Tuple[str, str]:
+    after, before = parse_cursor(cursor)
+    page = db.list_user_orders_page(user_id, after, before, path=DB_PATH)
+    if not page.rows:
+        return "История заказов пуста", back_keyboard("main")
+    stats = db.get_user_stats(user_id, DB_PATH)
+    blocks = [f"\U0001F9FE История заказов ({stats.orders}, всего {stats.spent} ⭐):"]
+    for order_id, total, created_at, items in page.rows:
+        names = ", ".join(
+            f"{escape(catalog[key]['name'] if key in catalog else key)} × {qty}" for key, qty in items
+        )
+        blocks.append(f"<b>#{order_id}</b> {_format_time(created_at)} · {total} ⭐\n{names}")
+    return "\n\n".join(blocks), page_keyboard("history", page, back="main")
 
 
 @bot.message_handler(commands=["history"])
 def cmd_history(message: types.Message) -> None:
-    orders = db.get_orders(message.from_user.id, DB_PATH)
-    if not orders:
-        bot.send_message(message.chat.id, "История заказов пуста")
-        return
-    lines = [f"{o['created_at']}: {o['total']} ⭐ - {o['items']}" for o in orders]
-    bot.send_message(message.chat.id, "\n".join(lines))
+    text, kb = history_screen(message.from_user.id)
+    api.send_message(message.chat.id, text, reply_markup=kb)
+
+
+@router.callback("history", prefix=True, validate=is_cursor)
+def cb_history(call: types.CallbackQuery, cursor: str) -> None:
+    edit(call, *history_screen(call.from_user.id, cursor))
+    api.answer_callback_query(call.id)
+
+
+@router.callback("my_stats")
+def cb_my_stats(call: types.CallbackQuery, arg: str) -> None:
+    user_id = call.from_user.id
+    stats = db.get_user_stats(user_id, DB_PATH)
+    text = (
+        "\U0001F4C8 Моя статистика\n"
+        f"Баланс: {db.get_stars(user_id, DB_PATH)} ⭐\n"
+        f"Заказов: {stats.orders}\n"
+        f"Потрачено: {stats.spent} ⭐\n"
+        f"Последний заказ: {_format_time(stats.last_order_at)}"
+    )
+    edit(call, text, my_stats_keyboard())
+    api.answer_callback_query(call.id)
 
 
 @bot.message_handler(commands=["addstars"])
@@ -317,60 +695,466 @@ def cmd_addstars(message: types.Message) -> None:
         return
     parts = message.text.split()
     if len(parts) != 3:
-        bot.send_message(message.chat.id, "Использование: /addstars <user_id> <amount>")
+        api.send_message(message.chat.id, "Использование: /addstars <user_id> <amount>")
         return
     try:
         user_id = int(parts[1])
         amount = int(parts[2])
         db.update_stars(user_id, amount, DB_PATH)
-        bot.send_message(message.chat.id, f"\u2705 Пользователю {user_id} добавлено {amount} ⭐")
+        api.send_message(message.chat.id, f"\u2705 Пользователю {user_id} добавлено {amount} ⭐")
     except ValueError:
-        bot.send_message(message.chat.id, "\u274C Неверный формат чисел")
+        api.send_message(message.chat.id, "\u274C Неверный формат чисел")
 
 
 @bot.message_handler(commands=["export"])
 def cmd_export(message: types.Message) -> None:
     if not is_admin(message.from_user.id):
         return
-    path = db.export_orders(DB_PATH)
-    with open(path, "rb") as f:
-        bot.send_document(message.chat.id, f)
+    path = db.export_orders(DB_PATH, compress=EXPORT_COMPRESS)
+    api.send_document(message.chat.id, types.InputFile(path))
+
 
+# Longest product or category key /product accepts, and the characters
+# allowed in one: keys go into callback data and messages as they are.
+KEY_MAX_BYTES = 48
+KEY_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
 
-@bot.callback_query_handler(func=lambda c: c.data == "admin")
-def cb_admin(call: types.CallbackQuery) -> None:
-    if not is_admin(call.from_user.id):
-        bot.answer_callback_query(call.id, "Доступ запрещён", show_alert=True)
+
+@bot.message_handler(commands=["product"])
+def cmd_product(message: types.Message) -> None:
+    if not is_admin(message.from_user.id):
         return
-    kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton("Пользователи", callback_data="admin_users"))
-    kb.add(types.InlineKeyboardButton("Заказы", callback_data="admin_orders"))
-    kb.add(types.InlineKeyboardButton("Назад", callback_data="main"))
-    bot.edit_message_text("Админ-панель:", chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=kb)
-    bot.answer_callback_query(call.id)
+    parts = [p.strip() for p in message.text.split(maxsplit=1)[-1].split("|")]
+    if len(parts) != 6:
+        api.send_message(message.chat.id, "Использование: /product ключ | категория | название | цена | эмодзи | описание")
+        return
+    key, category, name, price, emoji, desc = parts
+    # Both end up in callback data, which Telegram limits to 64 bytes.
+    if len(key.encode()) > KEY_MAX_BYTES or len(category.encode()) > KEY_MAX_BYTES:
+        api.send_message(message.chat.id, f"\u274C Ключ товара и категории – не длиннее {KEY_MAX_BYTES} байт")
+        return
+    if not KEY_PATTERN.fullmatch(key) or not KEY_PATTERN.fullmatch(category):
+        api.send_message(message.chat.id, "\u274C Ключ товара и категории – только латинские буквы, цифры, _ и -")
+        return
+    try:
+        db.upsert_product(key, category, name, int(price), emoji, desc, DB_PATH)
+    except ValueError:
+        api.send_message(message.chat.id, "\u274C Неверный формат цены")
+        return
+    catalog.reload()
+    api.send_message(message.chat.id, f"\u2705 Товар {key} сохранён")
 
 
-@bot.callback_query_handler(func=lambda c: c.data == "admin_users")
-def cb_admin_users(call: types.CallbackQuery) -> None:
-    ids = db.list_users(DB_PATH)
-    text = "\n".join(str(i) for i in ids) or "Нет пользователей"
-    kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton("Назад", callback_data="admin"))
-    bot.edit_message_text(text, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=kb)
-    bot.answer_callback_query(call.id)
+@bot.message_handler(commands=["hideproduct"])
+def cmd_hideproduct(message: types.Message) -> None:
+    if not is_admin(message.from_user.id):
+        return
+    parts = message.text.split()
+    if len(parts) != 2:
+        api.send_message(message.chat.id, "Использование: /hideproduct <ключ>")
+        return
+    if not db.set_product_active(parts[1], False, DB_PATH):
+        api.send_message(message.chat.id, "\u274C Товар не найден")
+        return
+    catalog.reload()
+    api.send_message(message.chat.id, f"\u2705 Товар {escape(parts[1])} скрыт")
+
+
+@bot.inline_handler(func=lambda q: True)
+def inline_search(query: types.InlineQuery) -> None:
+    results = []
+    for item in catalog.search(query.query):
+        kb = types.InlineKeyboardMarkup()
+        kb.add(types.InlineKeyboardButton("Открыть в боте", url=f"https://t.me/{bot.user.username}?start=view_{item['key']}"))
+        results.append(
+            types.InlineQueryResultArticle(
+                id=item["key"],
+                title=f"{item['emoji']} {item['name']}",
+                description=f"{item['price']} ⭐",
+                input_message_content=types.InputTextMessageContent(
+                    f"{escape(item['emoji'])} <b>{escape(item['name'])}</b>\n\n{escape(item['desc'])}\nСтоимость: {item['price']} ⭐",
+                    parse_mode="HTML",
+                ),
+                reply_markup=kb,
+            )
+        )
+    api.answer_inline_query(query.id, results, cache_time=int(CATALOG_REFRESH_SECONDS))
+
 
+def admin_call(call: types.CallbackQuery) -> bool:
+    """True for admins; everyone else gets an alert."""
+    if is_admin(call.from_user.id):
+        return True
+    api.answer_callback_query(call.id, "Доступ запрещён", show_alert=True)
+    return False
 
-@bot.callback_query_handler(func=lambda c: c.data == "admin_orders")
-def cb_admin_orders(call: types.CallbackQuery) -> None:
-    path = db.export_orders(DB_PATH, dest="admin_orders.csv")
-    with open(path, "rb") as f:
-        bot.send_document(call.from_user.id, f)
-    bot.answer_callback_query(call.id, "Файл отправлен")
+
+@router.callback("admin")
+def cb_admin(call: types.CallbackQuery, arg: str) -> None:
+    if not admin_call(call):
+        return
+    edit(call, "Админ-панель:", admin_keyboard())
+    api.answer_callback_query(call.id)
+
+
+@router.callback("admin_users", prefix=True, validate=is_cursor)
+def cb_admin_users(call: types.CallbackQuery, cursor: str) -> None:
+    if not admin_call(call):
+        return
+    after, before = parse_cursor(cursor)
+    page = db.list_users_page(after, before, path=DB_PATH)
+    lines = [f"<code>{user_id}</code> — {stars} ⭐" for user_id, stars in page.rows]
+    text = "\U0001F465 Пользователи:\n" + "\n".join(lines) if lines else "Нет пользователей"
+    edit(call, text, page_keyboard("admin_users", page))
+    api.answer_callback_query(call.id)
+
+
+class OrderFilter(NamedTuple):
+    date_from: Optional[date] = None
+    # Inclusive.
+    date_to: Optional[date] = None
+    min_total: Optional[int] = None
+
+    def encode(self) -> str:
+        """Compact form carried in callback data, empty without filters."""
+        if self == OrderFilter():
+            return ""
+        parts = (
+            self.date_from.strftime("%Y%m%d") if self.date_from else "",
+            self.date_to.strftime("%Y%m%d") if self.date_to else "",
+            str(self.min_total) if self.min_total is not None else "",
+        )
+        return ":".join(parts)
+
+    @classmethod
+    def decode(cls, data: str) -> Optional["OrderFilter"]:
+        if not data:
+            return cls()
+        parts = data.split(":")
+        if len(parts) != 3:
+            return None
+        try:
+            return cls(
+                datetime.strptime(parts[0], "%Y%m%d").date() if parts[0] else None,
+                datetime.strptime(parts[1], "%Y%m%d").date() if parts[1] else None,
+                int(parts[2]) if parts[2] else None,
+            )
+        except ValueError:
+            return None
+
+    def describe(self) -> str:
+        parts = []
+        if self.date_from:
+            parts.append(f"с {self.date_from.isoformat()}")
+        if self.date_to:
+            parts.append(f"по {self.date_to.isoformat()}")
+        if self.min_total is not None:
+            parts.append(f"от {self.min_total} ⭐")
+        return " ".join(parts)
+
+
+def is_orders_arg(arg: str) -> bool:
+    cursor, _, filters = arg.partition(":")
+    return is_cursor(cursor) and OrderFilter.decode(filters) is not None
+
+
+def orders_screen(cursor: str, flt: OrderFilter) -> Tuple[str, str]:
+    after, before = parse_cursor(cursor)
+    page = db.list_orders_page(
+        after,
+        before,
+        date_from=flt.date_from.isoformat() if flt.date_from else None,
+        date_to=(flt.date_to + timedelta(days=1)).isoformat() if flt.date_to else None,
+        min_total=flt.min_total,
+        path=DB_PATH,
+    )
+    title = "\U0001F9FE Заказы"
+    if flt != OrderFilter():
+        title += f" ({flt.describe()})"
+    lines = [
+        f"#{order_id} {_format_time(created_at)} · <code>{user_id}</code> · {total} ⭐"
+        for order_id, user_id, total, created_at in page.rows
+    ]
+    if lines:
+        body = "\n".join(lines)
+    elif page.next is not None or page.prev is not None:
+        # A filtered page stops after ORDERS_SCAN_LIMIT orders.
+        body = "Среди просмотренных заказов подходящих нет, листайте дальше"
+    else:
+        body = "Нет заказов"
+    text = title + ":\n" + body
+    encoded = flt.encode()
+    return text, page_keyboard("admin_orders", page, f":{encoded}" if encoded else "")
+
+
+@router.callback("admin_orders", prefix=True, validate=is_orders_arg)
+def cb_admin_orders(call: types.CallbackQuery, arg: str) -> None:
+    if not admin_call(call):
+        return
+    cursor, _, filters = arg.partition(":")
+    edit(call, *orders_screen(cursor, OrderFilter.decode(filters)))
+    api.answer_callback_query(call.id)
+
+
+@bot.message_handler(commands=["orders"])
+def cmd_orders(message: types.Message) -> None:
+    if not is_admin(message.from_user.id):
+        return
+    options = dict(part.partition("=")[::2] for part in message.text.split()[1:])
+    try:
+        flt = OrderFilter(
+            date.fromisoformat(options["from"]) if options.get("from") else None,
+            date.fromisoformat(options["to"]) if options.get("to") else None,
+            int(options["min"]) if options.get("min") else None,
+        )
+    except ValueError:
+        flt = None
+    if flt is None or set(options) - {"from", "to", "min"}:
+        api.send_message(message.chat.id, "Использование: /orders [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД] [min=сумма]")
+        return
+    text, kb = orders_screen("", flt)
+    api.send_message(message.chat.id, text, reply_markup=kb)
+
+
+STATS_DAYS = 7
+
+
+def stats_text(days: int = STATS_DAYS) -> str:
+    report = db.sales_report(days, path=DB_PATH)
+    orders = sum(n for _, n, _ in report.days)
+    revenue = sum(r for _, _, r in report.days)
+    lines = [
+        f"\U0001F4CA Статистика за {days} дн. (UTC)",
+        f"Заказов: {orders}, выручка: {revenue} ⭐",
+    ]
+    if report.days:
+        lines.append("\nПо дням:")
+        lines += [f"{day}: {n} · {r} ⭐" for day, n, r in report.days]
+    if report.top:
+        lines.append("\nТоп товаров:")
+        lines += [
+            f"{escape(catalog[key]['name'] if key in catalog else key)} — {units} шт. · {r} ⭐"
+            for key, units, r in report.top
+        ]
+    if report.hours:
+        busiest = ", ".join(f"{h:02d}:00 ({n})" for h, n in report.hours[:3])
+        lines.append(f"\nЧасы пик: {busiest}")
+    lines.append(f"\nЗвёзды: выдано {report.issued} ⭐, потрачено {report.spent} ⭐")
+    return "\n".join(lines)
+
+
+@router.callback("admin_stats")
+def cb_admin_stats(call: types.CallbackQuery, arg: str) -> None:
+    if not admin_call(call):
+        return
+    edit(call, stats_text(), back_keyboard("admin"))
+    api.answer_callback_query(call.id)
+
+
+@bot.message_handler(commands=["stats"])
+def cmd_stats(message: types.Message) -> None:
+    if not is_admin(message.from_user.id):
+        return
+    parts = message.text.split()
+    if len(parts) > 2 or (len(parts) == 2 and not (parts[1].isdigit() and 0 < int(parts[1]) <= 366)):
+        api.send_message(message.chat.id, "Использование: /stats [число дней, до 366]")
+        return
+    api.send_message(message.chat.id, stats_text(int(parts[1]) if len(parts) == 2 else STATS_DAYS))
+
+
+@bot.message_handler(commands=["rebuild_stats"])
+def cmd_rebuild_stats(message: types.Message) -> None:
+    if not is_admin(message.from_user.id):
+        return
+    started = time.monotonic()
+    count = db.rebuild_sales_stats(DB_PATH)
+    elapsed = time.monotonic() - started
+    api.send_message(message.chat.id, f"\u2705 Статистика пересчитана по {count} заказам за {elapsed:.1f} с")
+
+
+@bot.message_handler(commands=["broadcast"])
+def cmd_broadcast(message: types.Message) -> None:
+    if not is_admin(message.from_user.id):
+        return
+    # html_text keeps the admin's formatting and escapes everything else.
+    parts = message.html_text.split(maxsplit=1)
+    if len(parts) != 2:
+        api.send_message(message.chat.id, "Использование: /broadcast <текст сообщения>")
+        return
+    job = broadcaster.start(parts[1], message.chat.id)
+    api.send_message(
+        message.chat.id,
+        f"\U0001F4E3 Рассылка #{job.id} запущена: {job.total} получателей.\n"
+        f"Остановить: /broadcast_stop {job.id}",
+    )
+
+
+@bot.message_handler(commands=["broadcast_stop"])
+def cmd_broadcast_stop(message: types.Message) -> None:
+    if not is_admin(message.from_user.id):
+        return
+    parts = message.text.split()
+    if len(parts) != 2 or not parts[1].isdigit():
+        api.send_message(message.chat.id, "Использование: /broadcast_stop <номер рассылки>")
+        return
+    if broadcaster.cancel(int(parts[1])):
+        api.send_message(message.chat.id, f"\u2705 Рассылка #{parts[1]} остановлена")
+    else:
+        api.send_message(message.chat.id, "\u274C Рассылка не найдена или уже завершена")
+
+
+@router.callback("admin_csv")
+def cb_admin_csv(call: types.CallbackQuery, arg: str) -> None:
+    if not admin_call(call):
+        return
+    path = db.export_orders(DB_PATH, dest="admin_orders.csv", compress=EXPORT_COMPRESS)
+    api.send_document(call.from_user.id, types.InputFile(path))
+    api.answer_callback_query(call.id, "Файл отправлен")
+
+
+def process_update(data: Dict[str, Any]) -> None:
+    """Run the handlers for one raw update dict in the calling thread."""
+    bot.process_new_updates([types.Update.de_json(data)])
+
+
+webhook_server: Optional[webhook.WebhookServer] = None
+
+
+def serve_webhook() -> None:
+    global webhook_server
+    # The webhook workers already run handlers in parallel; dispatching to
+    # TeleBot's own thread pool as well would only add another queue.
+    bot.threaded = False
+    webhook.check_secret(WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_URL)
+    server = webhook_server = webhook.WebhookServer(
+        process_update,
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        path=WEBHOOK_PATH,
+        secret=WEBHOOK_SECRET,
+        workers=WEBHOOK_WORKERS,
+        queue_size=WEBHOOK_QUEUE_SIZE,
+    )
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    server.serve_forever()
+
+
+# ---------------------------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------------------------
+_metrics_installed = False
+
+
+def _queue_depths() -> Dict[Tuple[str, ...], float]:
+    depths = {
+        ("notify",): notifier.depth(),
+        ("clicks",): clicks.depth(),
+        ("cart_write_behind",): db.cart_write_behind_depth(DB_PATH),
+    }
+    if webhook_server is not None:
+        depths[("webhook",)] = webhook_server.depth()
+    return depths
+
+
+def _cache_stat(cart_key: str, render: Callable[[], int]) -> Callable[[], Dict[Tuple[str, ...], float]]:
+    return lambda: {("cart",): db.cart_cache_stats()[cart_key], ("render",): render()}
+
+
+def setup_metrics() -> Optional[metrics.MetricsServer]:
+    """Instrument handlers, db.py and Telegram requests; serve them if enabled.
+
+    Everything is timed into ``metrics.registry`` regardless; the HTTP
+    endpoint only runs when ``METRICS_PORT`` is set. Call once, after all
+    handlers are registered.
+    """
+    global _metrics_installed
+    registry = metrics.registry
+    if not _metrics_installed:
+        _metrics_installed = True
+        handler_seconds = registry.histogram("bot_handler_seconds", "Time spent in update handlers.", ("handler",))
+        handler_errors = registry.counter("bot_handler_errors_total", "Exceptions raised by update handlers.", ("handler",))
+        for attr in ("message_handlers", "callback_query_handlers", "inline_handlers"):
+            for handler in getattr(bot, attr):
+                fn = handler["function"]
+                if fn is on_callback:
+                    # Routed callbacks are timed under their own handler below.
+                    continue
+                handler["function"] = registry.timed(fn, fn.__name__, handler_seconds, handler_errors, profile=True)
+        router.map_handlers(
+            lambda action, fn: registry.timed(fn, fn.__name__, handler_seconds, handler_errors, profile=True)
+        )
+
+        registry.instrument_module(
+            db,
+            registry.histogram("bot_db_seconds", "Time spent in db.py functions.", ("function",)),
+            registry.counter("bot_db_errors_total", "Exceptions raised by db.py functions.", ("function",)),
+        )
+
+        api_seconds = registry.histogram("bot_telegram_request_seconds", "Telegram Bot API request time.", ("method",))
+        api_errors = registry.counter("bot_telegram_errors_total", "Failed Telegram Bot API requests.", ("method",))
+        make_request = apihelper._make_request
+
+        def timed_request(token: str, method_name: str, *args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return make_request(token, method_name, *args, **kwargs)
+            except Exception:
+                api_errors.inc(method_name)
+                raise
+            finally:
+                api_seconds.observe(time.perf_counter() - started, method_name)
+
+        apihelper._make_request = timed_request
+
+        registry.gauge("bot_queue_depth", "Items waiting in background queues.", _queue_depths, ("queue",))
+        registry.gauge(
+            "bot_cache_hits_total", "Cache hits.",
+            _cache_stat("hits", lambda: render_cache.hits), ("cache",), kind="counter",
+        )
+        registry.gauge(
+            "bot_cache_misses_total", "Cache misses.",
+            _cache_stat("misses", lambda: render_cache.misses), ("cache",), kind="counter",
+        )
+        registry.gauge(
+            "bot_cache_entries", "Entries held by caches.",
+            _cache_stat("size", lambda: len(render_cache._entries)), ("cache",),
+        )
+        registry.gauge("bot_user_states", "Conversation states being tracked.", lambda: len(user_states))
+        # Read the index already loaded; a scrape must not query the database.
+        registry.gauge(
+            "bot_catalog_version", "Catalog version in memory.",
+            lambda: catalog._index.version if catalog._index else -1,
+        )
+    if METRICS_PROFILE_SLOW_MS > 0:
+        registry.profiler.enable(METRICS_PROFILE_SLOW_MS / 1000)
+    if not METRICS_PORT:
+        return None
+    server = metrics.MetricsServer(registry, METRICS_HOST, METRICS_PORT)
+    server.start()
+    return server
 
 
 def main() -> None:
     db.init_db(DB_PATH)
-    bot.infinity_polling()
+    metrics_server = setup_metrics()
+    if CART_WRITE_BEHIND:
+        db.enable_cart_write_behind(DB_PATH, CART_FLUSH_MS / 1000, CART_FLUSH_OPS)
+    broadcaster.resume()
+    try:
+        if BOT_MODE == "webhook":
+            serve_webhook()
+        else:
+            bot.infinity_polling()
+    finally:
+        broadcaster.stop()
+        clicks.join(timeout=5.0)
+        notifier.stop()
+        db.disable_cart_write_behind(DB_PATH)
+        db.close_connections()
+        if metrics_server is not None:
+            metrics_server.shutdown()
 
 
 if __name__ == "__main__":
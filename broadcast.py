@@ -0,0 +1,226 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from telebot.apihelper import ApiTelegramException
+
+import db
+from throttle import TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+# Telegram delivers about 30 messages per second per bot; leave room for
+# the regular replies.
+RATE = 25.0
+WORKERS = 8
+BATCH = 100
+MAX_ATTEMPTS = 5
+BACKOFF = 2.0
+MAX_BACKOFF = 300.0
+PROGRESS_INTERVAL = 30.0
+# How often the sending process looks for broadcasts started elsewhere.
+WATCH_INTERVAL = 1.0
+
+
+class Broadcaster:
+    """Sends broadcasts stored in the ``broadcasts`` table to every user.
+
+    Each running broadcast has a job thread that takes due recipients from
+    ``broadcast_recipients`` in batches of ``batch`` and sends them on a
+    shared pool of ``workers`` threads. All sends draw from one token
+    bucket of ``rate`` messages per second, and a 429 from Telegram pauses
+    every sender for the ``retry_after`` it asks for. Failed sends are
+    retried with exponential backoff up to ``max_attempts`` times; users
+    who blocked the bot are marked and skipped from then on.
+
+    The outcome of each batch is written before the next one is taken, so
+    after a restart :meth:`resume` continues where the job stopped; at
+    most the batch in flight at the time may be delivered twice. ``report``
+    receives ``(chat_id, text)`` progress messages for the admin who
+    started the broadcast, every ``progress_interval`` seconds and at the
+    end.
+
+    The rate limit and 429 pauses only hold within one process. When
+    several processes share the database, only one of them should send:
+    the others are created with ``run_jobs=False``, so :meth:`start` just
+    stores the broadcast, and the sending one picks it up with
+    :meth:`watch`.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[int, str], object],
+        report: Callable[[int, str], object],
+        path: str = db.DB_PATH,
+        rate: float = RATE,
+        workers: int = WORKERS,
+        batch: int = BATCH,
+        max_attempts: int = MAX_ATTEMPTS,
+        progress_interval: float = PROGRESS_INTERVAL,
+        run_jobs: bool = True,
+    ) -> None:
+        self.send = send
+        self.report = report
+        self.path = path
+        self.batch = batch
+        self.max_attempts = max_attempts
+        self.progress_interval = progress_interval
+        self.run_jobs = run_jobs
+        self._bucket = TokenBucket(rate, rate)
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="broadcast")
+        self._jobs: Dict[int, threading.Thread] = {}
+        self._cancelled: Dict[int, threading.Event] = {}
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+
+    def start(self, text: str, chat_id: int) -> db.Broadcast:
+        broadcast = db.create_broadcast(text, chat_id, self.path)
+        if self.run_jobs:
+            self._spawn(broadcast)
+        return broadcast
+
+    def resume(self) -> List[db.Broadcast]:
+        """Restart the jobs of broadcasts that were running at shutdown."""
+        broadcasts = db.running_broadcasts(self.path)
+        for broadcast in broadcasts:
+            self._spawn(broadcast)
+        return broadcasts
+
+    def watch(self, stop: threading.Event, interval: float = WATCH_INTERVAL) -> None:
+        """Start broadcasts stored by other processes until ``stop`` is set."""
+        while not stop.wait(interval):
+            try:
+                self.resume()
+            except Exception:
+                logger.exception("Could not look for new broadcasts")
+
+    def cancel(self, broadcast_id: int) -> bool:
+        if not db.finish_broadcast(broadcast_id, db.BROADCAST_CANCELLED, self.path):
+            return False
+        with self._lock:
+            event = self._cancelled.get(broadcast_id)
+        if event is not None:
+            event.set()
+        return True
+
+    def stop(self, timeout: Optional[float] = 5.0) -> None:
+        """Stop all jobs after their current batch; they stay resumable."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+            for event in self._cancelled.values():
+                event.set()
+        for job in jobs:
+            job.join(timeout)
+
+    def _spawn(self, broadcast: db.Broadcast) -> None:
+        with self._lock:
+            if broadcast.id in self._jobs:
+                return
+            self._cancelled[broadcast.id] = threading.Event()
+            thread = threading.Thread(
+                target=self._run, args=(broadcast,), name=f"broadcast-{broadcast.id}", daemon=True
+            )
+            self._jobs[broadcast.id] = thread
+        thread.start()
+
+    def _run(self, broadcast: db.Broadcast) -> None:
+        stop = self._cancelled[broadcast.id]
+        started = time.monotonic()
+        done_at_start = broadcast.sent + broadcast.failed + broadcast.blocked
+        next_report = started + self.progress_interval
+        try:
+            while not stop.is_set():
+                rows = db.broadcast_batch(broadcast.id, time.time(), self.batch, self.path)
+                if not rows:
+                    due = db.next_broadcast_retry(broadcast.id, self.path)
+                    if due is None:
+                        db.finish_broadcast(broadcast.id, db.BROADCAST_DONE, self.path)
+                        break
+                    stop.wait(max(due - time.time(), 0.05))
+                    continue
+                futures = [
+                    self._executor.submit(self._deliver, user_id, broadcast.text, attempts, stop)
+                    for user_id, attempts in rows
+                ]
+                results = [f.result() for f in futures]
+                db.record_broadcast_results(
+                    broadcast.id, [r for r in results if r is not None], self.path
+                )
+                # It may have been cancelled from another process.
+                current = db.get_broadcast(broadcast.id, self.path)
+                if current is None or current.status != db.BROADCAST_RUNNING:
+                    break
+                if time.monotonic() >= next_report:
+                    next_report = time.monotonic() + self.progress_interval
+                    self._report(broadcast.id, started, done_at_start)
+        except Exception:
+            logger.exception("Broadcast %s stopped", broadcast.id)
+        finally:
+            with self._lock:
+                self._jobs.pop(broadcast.id, None)
+                self._cancelled.pop(broadcast.id, None)
+        current = db.get_broadcast(broadcast.id, self.path)
+        if current is not None and current.status != db.BROADCAST_RUNNING:
+            self._report(broadcast.id, started, done_at_start)
+
+    def _deliver(
+        self, user_id: int, text: str, attempts: int, stop: threading.Event
+    ) -> Optional[db.RecipientResult]:
+        """Send to one recipient; None if the job stopped before sending."""
+        while True:
+            if stop.is_set():
+                return None
+            wait = self._paused_until - time.monotonic()
+            if wait <= 0:
+                wait = self._bucket.take()
+            if wait <= 0:
+                break
+            stop.wait(wait)
+        attempts += 1
+        try:
+            self.send(user_id, text)
+            return user_id, db.RECIPIENT_SENT, attempts, 0.0, None
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                params = (e.result_json or {}).get("parameters") or {}
+                retry_after = float(params.get("retry_after", BACKOFF))
+                with self._lock:
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                # Throttling says nothing about the recipient.
+                return user_id, db.RECIPIENT_PENDING, attempts - 1, time.time() + retry_after, str(e)
+            if e.error_code == 403:
+                return user_id, db.RECIPIENT_BLOCKED, attempts, 0.0, str(e)
+            if e.error_code == 400:
+                return user_id, db.RECIPIENT_FAILED, attempts, 0.0, str(e)
+            error = str(e)
+        except Exception as e:
+            error = repr(e)
+        if attempts >= self.max_attempts:
+            logger.warning("Giving up on broadcast to %s: %s", user_id, error)
+            return user_id, db.RECIPIENT_FAILED, attempts, 0.0, error
+        delay = min(BACKOFF ** attempts, MAX_BACKOFF)
+        return user_id, db.RECIPIENT_PENDING, attempts, time.time() + delay, error
+
+    def _report(self, broadcast_id: int, started: float, done_at_start: int) -> None:
+        b = db.get_broadcast(broadcast_id, self.path)
+        if b is None:
+            return
+        done = b.sent + b.failed + b.blocked
+        elapsed = max(time.monotonic() - started, 1e-6)
+        state = {
+            db.BROADCAST_RUNNING: "идёт",
+            db.BROADCAST_DONE: "завершена",
+            db.BROADCAST_CANCELLED: "остановлена",
+        }.get(b.status, b.status)
+        text = (
+            f"\U0001F4E3 Рассылка #{b.id} {state}: {done} из {b.total}\n"
+            f"Доставлено: {b.sent}, заблокировали бота: {b.blocked}, ошибок: {b.failed}\n"
+            f"Скорость: {(done - done_at_start) / elapsed:.1f} сообщ./с"
+        )
+        try:
+            self.report(b.chat_id, text)
+        except Exception:
+            logger.warning("Could not report progress of broadcast %s", b.id, exc_info=True)
@@ -0,0 +1,158 @@
+import bisect
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import db
+
+
+Product = Dict[str, object]
+
+REFRESH_INTERVAL = 5.0
+PAGE_SIZE = 8
+SEARCH_LIMIT = 20
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class _Index(NamedTuple):
+    version: int
+    categories: List[Dict[str, object]]
+    by_key: Dict[str, Product]
+    by_category: Dict[str, List[Product]]
+    # Sorted (word, key) pairs of every word of every product name.
+    words: List[Tuple[str, str]]
+    trigrams: Dict[str, Set[str]]
+    names: Dict[str, str]
+    positions: Dict[str, int]
+
+
+def _build_index(
+    version: int, categories: List[Dict[str, object]], products: List[Product]
+) -> _Index:
+    by_key: Dict[str, Product] = {}
+    by_category: Dict[str, List[Product]] = {c["key"]: [] for c in categories}
+    words: List[Tuple[str, str]] = []
+    trigrams: Dict[str, Set[str]] = {}
+    names: Dict[str, str] = {}
+    positions: Dict[str, int] = {}
+    for position, product in enumerate(products):
+        key = product["key"]
+        name = str(product["name"]).lower()
+        by_key[key] = product
+        by_category.setdefault(product["category"], []).append(product)
+        names[key] = name
+        positions[key] = position
+        words.extend((word, key) for word in name.split())
+        for gram in _trigrams(name):
+            trigrams.setdefault(gram, set()).add(key)
+    words.sort()
+    return _Index(version, categories, by_key, by_category, words, trigrams, names, positions)
+
+
+class Catalog:
+    """In-memory view of the ``products`` table.
+
+    The whole catalog is loaded into indexes by key, by category and over
+    product names (word prefixes and trigrams). The catalog version in the
+    database is polled at most every ``refresh_interval`` seconds and the
+    indexes are rebuilt when it changes, so edits made by any process show up
+    without a restart. Readers always see one consistent snapshot.
+    """
+
+    def __init__(self, path: str = db.DB_PATH, refresh_interval: float = REFRESH_INTERVAL) -> None:
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self._index: Optional[_Index] = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> int:
+        return self._current().version
+
+    def reload(self) -> None:
+        """Rebuild the indexes now, e.g. right after editing the catalog."""
+        with self._lock:
+            self._index = _build_index(*db.load_catalog(self.path))
+            self._checked = time.monotonic()
+
+    def get(self, key: str) -> Optional[Product]:
+        return self._current().by_key.get(key)
+
+    def __getitem__(self, key: str) -> Product:
+        return self._current().by_key[key]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._current().by_key
+
+    def categories(self) -> List[Dict[str, object]]:
+        return self._current().categories
+
+    def category(self, key: str) -> Optional[Dict[str, object]]:
+        for category in self._current().categories:
+            if category["key"] == key:
+                return category
+        return None
+
+    def in_category(self, category: str) -> List[Product]:
+        return self._current().by_category.get(category, [])
+
+    def page(self, category: str, page: int, per_page: int = PAGE_SIZE) -> Tuple[List[Product], int]:
+        """Return the products on ``page`` (0-based) and the number of pages."""
+        products = self.in_category(category)
+        pages = max(1, -(-len(products) // per_page))
+        page = min(max(page, 0), pages - 1)
+        return products[page * per_page:(page + 1) * per_page], pages
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT) -> List[Product]:
+        """Products whose name matches every word of ``query``.
+
+        A query word matches a name word it is a prefix of; words of three or
+        more characters also match anywhere inside the name (via trigrams).
+        """
+        index = self._current()
+        terms = query.lower().split()
+        if not terms:
+            keys = list(index.by_key)
+        else:
+            found: Optional[Set[str]] = None
+            for term in terms:
+                matches = self._match(index, term)
+                found = matches if found is None else found & matches
+                if not found:
+                    return []
+            q = " ".join(terms)
+            keys = sorted(
+                found, key=lambda k: (not index.names[k].startswith(q), index.positions[k])
+            )
+        return [index.by_key[key] for key in keys[:limit]]
+
+    @staticmethod
+    def _match(index: _Index, term: str) -> Set[str]:
+        matches: Set[str] = set()
+        words = index.words
+        position = bisect.bisect_left(words, (term, ""))
+        while position < len(words) and words[position][0].startswith(term):
+            matches.add(words[position][1])
+            position += 1
+        if len(term) >= 3:
+            grams = _trigrams(term)
+            candidates = set.intersection(*(index.trigrams.get(g, set()) for g in grams))
+            matches.update(k for k in candidates if term in index.names[k])
+        return matches
+
+    def _current(self) -> _Index:
+        index = self._index
+        now = time.monotonic()
+        if index is not None and now - self._checked < self.refresh_interval:
+            return index
+        with self._lock:
+            if self._index is not None and now - self._checked < self.refresh_interval:
+                return self._index
+            self._checked = now
+            if self._index is None or db.get_catalog_version(self.path) != self._index.version:
+                self._index = _build_index(*db.load_catalog(self.path))
+            return self._index
@@ -1,18 +1,346 @@
 import sqlite3
+import csv
+import gzip
 import json
-from datetime import datetime
-from typing import List, Tuple, Dict
+import os
+import atexit
+import logging
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 
 DB_PATH = "bot.db"
 
+# Size of the per-connection prepared statement cache. The handlers only use
+# a few dozen distinct statements, so all of them stay compiled.
+STATEMENT_CACHE_SIZE = 256
+BUSY_TIMEOUT_MS = 5000
+# Rows fetched per round trip when streaming large result sets.
+EXPORT_CHUNK_SIZE = 500
+# Rows per page of the admin user and order browsers.
+ADMIN_PAGE_SIZE = 20
+# Orders a filtered page of the admin order browser reads at most.
+ORDERS_SCAN_LIMIT = 2000
+# Orders per page of a user's history.
+HISTORY_PAGE_SIZE = 5
+
+_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}",
+)
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+# Pooled connections by the thread that opened them.
+_connections: Dict[threading.Thread, List[sqlite3.Connection]] = {}
+_connections_lock = threading.Lock()
+_generation = 0
+
 
 def _connect(path: str = DB_PATH) -> sqlite3.Connection:
-    return sqlite3.connect(path)
+    """Return the calling thread's long-lived connection to ``path``.
+
+    Connections are opened once per (thread, path) and kept for the lifetime
+    of the thread, so repeated calls reuse the same statement cache. Using the
+    connection as a context manager still commits or rolls back as before.
+    Connections of threads that have exited are closed the next time any
+    thread opens one.
+    """
+    conns = getattr(_local, "conns", None)
+    if conns is None or _local.generation != _generation:
+        conns = _local.conns = {}
+        _local.generation = _generation
+    conn = conns.get(path)
+    if conn is None:
+        # Each connection is only ever used by the thread that opened it;
+        # disabling the thread check lets close_connections() run anywhere.
+        conn = sqlite3.connect(
+            path,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            check_same_thread=False,
+        )
+        for pragma in _PRAGMAS:
+            conn.execute(pragma)
+        conns[path] = conn
+        with _connections_lock:
+            dead = [t for t in _connections if not t.is_alive()]
+            stale = [c for t in dead for c in _connections.pop(t)]
+            _connections.setdefault(threading.current_thread(), []).append(conn)
+        for old in stale:
+            old.close()
+    return conn
+
+
+def close_connections() -> None:
+    """Close every pooled connection; threads reconnect on next use."""
+    global _generation
+    with _connections_lock:
+        conns = [c for owned in _connections.values() for c in owned]
+        _connections.clear()
+        _generation += 1
+    for conn in conns:
+        conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Migrations
+# ---------------------------------------------------------------------------
+# The schema version is stored in PRAGMA user_version. Migration N (1-based
+# position in _MIGRATIONS) upgrades a database from version N-1 to N; each one
+# runs in its own transaction together with the version bump. Append new
+# migrations, never edit or reorder released ones.
+def _migrate_order_indexes(db: sqlite3.Connection) -> None:
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at)"
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at)")
+
+
+def _migrate_order_items(db: sqlite3.Connection) -> None:
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS order_items (
+            order_id INTEGER NOT NULL REFERENCES orders(id),
+            drug_key TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            price INTEGER,
+            PRIMARY KEY (order_id, drug_key)
+        )"""
+    )
+    # Covers per-product queries (units, revenue, which orders) entirely.
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_order_items_drug ON order_items(drug_key, order_id, quantity, price)"
+    )
+    cur = db.execute("SELECT id, items FROM orders")
+    while True:
+        rows = cur.fetchmany(EXPORT_CHUNK_SIZE)
+        if not rows:
+            break
+        # Prices were not recorded before this table existed.
+        db.executemany(
+            "INSERT OR IGNORE INTO order_items(order_id, drug_key, quantity, price) VALUES (?, ?, ?, NULL)",
+            [
+                (order_id, key, qty)
+                for order_id, items in rows
+                for key, qty in json.loads(items or "[]")
+            ],
+        )
+
+
+# Catalog shipped before products moved into the database.
+_SEED_CATEGORIES = [
+    ("drugs", "\U0001F48A Препараты", 0),
+    ("subscriptions", "\U0001F4E6 Подписки", 1),
+]
+_SEED_PRODUCTS = [
+    ("ragvizax", "drugs", "Рагвизакс", "\U0001F33C АСИТ-препарат против аллергии на амброзию.", 11300, "\U0001F33C", 0),
+    ("grazax", "drugs", "Гразакс", "\U0001F33F АСИТ-препарат от злаковых трав.", 8300, "\U0001F33F", 1),
+    ("ragvizax_year", "subscriptions", "Подписка на Рагвизакс", "\U0001F4E6 Подписка на 1 год на курс АСИТ.", 110000, "\U0001F4E6", 0),
+    ("grazax_year", "subscriptions", "Подписка на Гразакс", "\U0001F4E6 Подписка на 1 год на курс лечения.", 90000, "\U0001F4E6", 1),
+]
+
+
+def _migrate_catalog(db: sqlite3.Connection) -> None:
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS categories (
+            key TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            position INTEGER NOT NULL DEFAULT 0
+        )"""
+    )
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS products (
+            key TEXT PRIMARY KEY,
+            category TEXT NOT NULL REFERENCES categories(key),
+            name TEXT NOT NULL,
+            description TEXT NOT NULL DEFAULT '',
+            price INTEGER NOT NULL,
+            emoji TEXT NOT NULL DEFAULT '',
+            position INTEGER NOT NULL DEFAULT 0,
+            active INTEGER NOT NULL DEFAULT 1
+        )"""
+    )
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_products_category ON products(category, position, key)"
+    )
+    # A single counter bumped by triggers on every catalog change, so other
+    # processes can detect changes with one primary-key lookup.
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS catalog_meta (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )"""
+    )
+    db.execute("INSERT OR IGNORE INTO catalog_meta(id, version) VALUES (1, 0)")
+    for table in ("categories", "products"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            db.execute(
+                f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE catalog_meta SET version = version + 1 WHERE id = 1;
+                END"""
+            )
+    db.executemany(
+        "INSERT OR IGNORE INTO categories(key, title, position) VALUES (?, ?, ?)",
+        _SEED_CATEGORIES,
+    )
+    db.executemany(
+        "INSERT OR IGNORE INTO products(key, category, name, description, price, emoji, position) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        _SEED_PRODUCTS,
+    )
+
+
+def _migrate_user_states(db: sqlite3.Connection) -> None:
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS user_states (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )"""
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS idx_user_states_expires ON user_states(expires_at)")
+
+
+def _migrate_user_stats(db: sqlite3.Connection) -> None:
+    # Per-user totals kept up to date by _insert_order, so summaries are a
+    # primary-key lookup instead of an aggregate over the user's orders.
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            orders INTEGER NOT NULL,
+            spent INTEGER NOT NULL,
+            last_order_at TEXT
+        )"""
+    )
+    db.execute(
+        """INSERT OR IGNORE INTO user_stats(user_id, orders, spent, last_order_at)
+        SELECT user_id, COUNT(*), COALESCE(SUM(total), 0), MAX(created_at)
+        FROM orders GROUP BY user_id"""
+    )
+    # Lets history pages walk one user's orders by id.
+    db.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders(user_id, id)")
+
+
+def _migrate_sales_stats(db: sqlite3.Connection) -> None:
+    # Aggregates for /stats, maintained by _insert_order and update_stars.
+    # Days and hours are UTC prefixes of created_at ("2024-05-01", "2024-05-01T13").
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS sales_daily (
+            day TEXT NOT NULL,
+            drug_key TEXT NOT NULL,
+            units INTEGER NOT NULL,
+            revenue INTEGER NOT NULL,
+            PRIMARY KEY (day, drug_key)
+        )"""
+    )
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS orders_hourly (
+            hour TEXT PRIMARY KEY,
+            orders INTEGER NOT NULL,
+            revenue INTEGER NOT NULL
+        )"""
+    )
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS stars_daily (
+            day TEXT PRIMARY KEY,
+            issued INTEGER NOT NULL DEFAULT 0,
+            spent INTEGER NOT NULL DEFAULT 0
+        )"""
+    )
+    # Issued stars were never recorded, only spending can be backfilled.
+    _rebuild_sales_stats(db)
+
+
+def _migrate_broadcasts(db: sqlite3.Connection) -> None:
+    db.execute("ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0")
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL,
+            finished_at TEXT
+        )"""
+    )
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id INTEGER NOT NULL REFERENCES broadcasts(id),
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_at REAL NOT NULL DEFAULT 0,
+            error TEXT,
+            PRIMARY KEY (broadcast_id, user_id)
+        )"""
+    )
+    # Only the recipients still to be sent are indexed for the sender.
+    db.execute(
+        """CREATE INDEX IF NOT EXISTS idx_broadcast_pending
+        ON broadcast_recipients(broadcast_id, next_at) WHERE status = 'pending'"""
+    )
+
+
+def _migrate_sales_revenue(db: sqlite3.Connection) -> None:
+    # Version 6 counted items without a recorded price as 0 revenue.
+    _rebuild_sales_stats(db)
+
+
+_MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _migrate_order_indexes,
+    _migrate_order_items,
+    _migrate_catalog,
+    _migrate_user_states,
+    _migrate_user_stats,
+    _migrate_sales_stats,
+    _migrate_broadcasts,
+    _migrate_sales_revenue,
+]
+
+
+def _migrate(db: sqlite3.Connection) -> None:
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(_MIGRATIONS[version:], start=version + 1):
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may have migrated while we waited for the lock.
+            if db.execute("PRAGMA user_version").fetchone()[0] >= number:
+                db.rollback()
+                continue
+            migration(db)
+            db.execute(f"PRAGMA user_version = {number}")
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+        logger.info("Database migrated to schema version %d", number)
+
+
+def schema_version(path: str = DB_PATH) -> int:
+    return _connect(path).execute("PRAGMA user_version").fetchone()[0]
 
 
 def init_db(path: str = DB_PATH) -> None:
     with _connect(path) as db:
+        # WAL is persistent in the database file, so it only has to be
+        # switched on once; readers no longer block the writer.
+        db.execute("PRAGMA journal_mode = WAL")
         db.execute(
             """CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -38,13 +366,24 @@ def init_db(path: str = DB_PATH) -> None:
                 created_at TEXT
             )"""
         )
+        db.execute(
+            """CREATE TABLE IF NOT EXISTS export_state (
+                dest TEXT PRIMARY KEY,
+                last_id INTEGER,
+                size INTEGER,
+                columns TEXT
+            )"""
+        )
         db.commit()
+        _migrate(db)
 
 
 def add_user(user_id: int, path: str = DB_PATH) -> None:
     with _connect(path) as db:
+        # A user who blocked the bot and came back gets broadcasts again.
         db.execute(
-            "INSERT OR IGNORE INTO users(user_id, stars) VALUES(?, 0)",
+            """INSERT INTO users(user_id, stars) VALUES(?, 0)
+            ON CONFLICT(user_id) DO UPDATE SET blocked = 0 WHERE blocked != 0""",
             (user_id,),
         )
         db.commit()
@@ -60,6 +399,12 @@ def update_stars(user_id: int, delta: int, path: str = DB_PATH) -> None:
             "UPDATE users SET stars = stars + ? WHERE user_id = ?",
             (delta, user_id),
         )
+        # Manual corrections count as negative issuance, not as spending.
+        db.execute(
+            """INSERT INTO stars_daily(day, issued) VALUES (?, ?)
+            ON CONFLICT(day) DO UPDATE SET issued = issued + excluded.issued""",
+            (datetime.utcnow().date().isoformat(), delta),
+        )
         db.commit()
 
 
@@ -70,45 +415,596 @@ def get_stars(user_id: int, path: str = DB_PATH) -> int:
         return row[0] if row else 0
 
 
-def add_to_cart(user_id: int, drug_key: str, qty: int = 1, path: str = DB_PATH) -> None:
+# ---------------------------------------------------------------------------
+# Catalog
+# ---------------------------------------------------------------------------
+def get_catalog_version(path: str = DB_PATH) -> int:
+    with _connect(path) as db:
+        row = db.execute("SELECT version FROM catalog_meta WHERE id = 1").fetchone()
+        return row[0] if row else 0
+
+
+def load_catalog(
+    path: str = DB_PATH,
+) -> Tuple[int, List[Dict[str, object]], List[Dict[str, object]]]:
+    """Return ``(version, categories, active products)`` in display order."""
+    with _connect(path) as db:
+        # One read transaction so the version matches the rows.
+        db.execute("BEGIN")
+        try:
+            version = db.execute("SELECT version FROM catalog_meta WHERE id = 1").fetchone()[0]
+            cur = db.execute("SELECT key, title FROM categories ORDER BY position, key")
+            categories = [{"key": key, "title": title} for key, title in cur]
+            cur = db.execute(
+                """SELECT key, category, name, description, price, emoji
+                FROM products WHERE active = 1
+                ORDER BY category, position, key"""
+            )
+            products = [
+                {
+                    "key": key,
+                    "category": category,
+                    "name": name,
+                    "desc": description,
+                    "price": price,
+                    "emoji": emoji,
+                }
+                for key, category, name, description, price, emoji in cur
+            ]
+        finally:
+            db.commit()
+    return version, categories, products
+
+
+def upsert_product(
+    key: str,
+    category: str,
+    name: str,
+    price: int,
+    emoji: str = "",
+    desc: str = "",
+    path: str = DB_PATH,
+) -> None:
+    """Create or update a product and make it active.
+
+    Unknown categories are created with the key as the title.
+    """
     with _connect(path) as db:
         db.execute(
-            "INSERT OR IGNORE INTO cart(user_id, drug_key, quantity) VALUES(?, ?, 0)",
-            (user_id, drug_key),
+            "INSERT OR IGNORE INTO categories(key, title, position) VALUES (?, ?, (SELECT COUNT(*) FROM categories))",
+            (category, category),
         )
         db.execute(
-            "UPDATE cart SET quantity = quantity + ? WHERE user_id = ? AND drug_key = ?",
-            (qty, user_id, drug_key),
+            """INSERT INTO products(key, category, name, description, price, emoji, position, active)
+            VALUES (?, ?, ?, ?, ?, ?, (SELECT COUNT(*) FROM products WHERE category = ?), 1)
+            ON CONFLICT(key) DO UPDATE SET
+                category = excluded.category,
+                name = excluded.name,
+                description = excluded.description,
+                price = excluded.price,
+                emoji = excluded.emoji,
+                active = 1""",
+            (key, category, name, desc, price, emoji, category),
         )
         db.commit()
 
 
-def remove_from_cart(user_id: int, drug_key: str, qty: int = 1, path: str = DB_PATH) -> None:
+def set_product_active(key: str, active: bool, path: str = DB_PATH) -> bool:
     with _connect(path) as db:
-        db.execute(
-            "UPDATE cart SET quantity = quantity - ? WHERE user_id = ? AND drug_key = ?",
-            (qty, user_id, drug_key),
+        cur = db.execute(
+            "UPDATE products SET active = ? WHERE key = ?",
+            (int(active), key),
         )
+        db.commit()
+        return cur.rowcount > 0
+
+
+# ---------------------------------------------------------------------------
+# Conversation states
+# ---------------------------------------------------------------------------
+def save_state(user_id: int, data: Dict[str, object], expires_at: float, path: str = DB_PATH) -> None:
+    with _connect(path) as db:
         db.execute(
-            "DELETE FROM cart WHERE user_id = ? AND drug_key = ? AND quantity <= 0",
-            (user_id, drug_key),
+            "INSERT OR REPLACE INTO user_states(user_id, data, expires_at) VALUES (?, ?, ?)",
+            (user_id, json.dumps(data, ensure_ascii=False), expires_at),
         )
         db.commit()
 
 
-def clear_cart(user_id: int, path: str = DB_PATH) -> None:
+def load_state(user_id: int, path: str = DB_PATH) -> Optional[Tuple[Dict[str, object], float]]:
     with _connect(path) as db:
-        db.execute("DELETE FROM cart WHERE user_id = ?", (user_id,))
+        row = db.execute(
+            "SELECT data, expires_at FROM user_states WHERE user_id = ?",
+            (user_id,),
+        ).fetchone()
+    return (json.loads(row[0]), row[1]) if row else None
+
+
+def delete_state(user_id: int, path: str = DB_PATH, expires_at: Optional[float] = None) -> None:
+    """Delete the user's state; with ``expires_at`` only if it is still that one."""
+    with _connect(path) as db:
+        if expires_at is None:
+            db.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
+        else:
+            db.execute("DELETE FROM user_states WHERE user_id = ? AND expires_at = ?", (user_id, expires_at))
         db.commit()
 
 
-def get_cart(user_id: int, path: str = DB_PATH) -> List[Tuple[str, int]]:
+def live_states(
+    now: float,
+    limit: int,
+    path: str = DB_PATH,
+    partition: Optional[Tuple[int, int]] = None,
+) -> List[Tuple[int, float]]:
+    """``(user_id, expires_at)`` of the ``limit`` unexpired states that expire
+    last, soonest expiry first.
+
+    With ``partition=(index, count)`` only users with ``user_id % count ==
+    index`` are returned.
+    """
+    where = "expires_at > ?"
+    params: List[object] = [now]
+    if partition is not None:
+        where += " AND user_id % ? = ?"
+        params += [partition[1], partition[0]]
     with _connect(path) as db:
         cur = db.execute(
-            "SELECT drug_key, quantity FROM cart WHERE user_id = ?",
-            (user_id,),
+            f"SELECT user_id, expires_at FROM user_states WHERE {where} ORDER BY expires_at DESC LIMIT ?",
+            params + [limit],
+        )
+        return cur.fetchall()[::-1]
+
+
+def purge_states(now: float, limit: int, path: str = DB_PATH) -> int:
+    """Delete up to ``limit`` expired states; returns how many were removed."""
+    with _connect(path) as db:
+        cur = db.execute(
+            """DELETE FROM user_states WHERE user_id IN (
+                SELECT user_id FROM user_states WHERE expires_at <= ? ORDER BY expires_at LIMIT ?
+            )""",
+            (now, limit),
         )
-        return cur.fetchall()
+        db.commit()
+        return cur.rowcount
+
+
+# ---------------------------------------------------------------------------
+# Cart write-behind
+# ---------------------------------------------------------------------------
+# A pending cart change for one (user_id, drug_key) is kept as the pair
+# (delta, floor) meaning "quantity -> max(quantity + delta, floor)". Adding and
+# removing are both of that form and so is any sequence of them, which lets a
+# burst of presses collapse into one UPDATE with exactly the same result as
+# running them one by one (removing from an empty row stays at zero).
+_CartOp = Tuple[int, int]
+
+CART_FLUSH_INTERVAL = 0.005
+CART_FLUSH_MAX_OPS = 256
+
+
+def _compose(first: _CartOp, then: _CartOp) -> _CartOp:
+    return first[0] + then[0], max(first[1] + then[0], then[1])
+
+
+def _apply(quantity: int, op: _CartOp) -> int:
+    return max(quantity + op[0], op[1])
+
+
+def _write_cart_ops(db: sqlite3.Connection, rows: List[Tuple[int, str, _CartOp]]) -> None:
+    db.executemany(
+        "INSERT OR IGNORE INTO cart(user_id, drug_key, quantity) VALUES(?, ?, 0)",
+        [(user_id, key) for user_id, key, _ in rows],
+    )
+    db.executemany(
+        "UPDATE cart SET quantity = MAX(quantity + ?, ?) WHERE user_id = ? AND drug_key = ?",
+        [(op[0], op[1], user_id, key) for user_id, key, op in rows],
+    )
+    db.executemany(
+        "DELETE FROM cart WHERE user_id = ? AND drug_key = ? AND quantity <= 0",
+        [(user_id, key) for user_id, key, _ in rows],
+    )
+
+
+class _CartWriteBehind:
+    """Queues cart changes and writes them in one transaction per flush."""
+
+    def __init__(self, path: str, interval: float, max_ops: int) -> None:
+        self.path = path
+        self.interval = interval
+        self.max_ops = max_ops
+        self._pending: Dict[int, Dict[str, _CartOp]] = {}
+        self._ops = 0
+        self._lock = threading.Lock()
+        # Held while a batch is being written and by synchronous cart
+        # statements, so readers never see a batch both queued and applied.
+        self.flush_lock = threading.RLock()
+        # Set while changes are queued; the flush thread sleeps on it when idle.
+        self._queued = threading.Event()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f"cart-write-behind:{path}", daemon=True
+        )
+        self._thread.start()
+
+    def push(self, user_id: int, drug_key: str, delta: int) -> None:
+        with self._lock:
+            if not self._pending:
+                self._queued.set()
+            user = self._pending.setdefault(user_id, {})
+            user[drug_key] = _compose(user.get(drug_key, (0, 0)), (delta, 0))
+            self._ops += 1
+            if self._ops >= self.max_ops:
+                self._wake.set()
+
+    def pending(self, user_id: int) -> Dict[str, _CartOp]:
+        with self._lock:
+            return dict(self._pending.get(user_id, {}))
+
+    def discard(self, user_id: int) -> None:
+        """Drop queued changes of ``user_id``; call with ``flush_lock`` held."""
+        with self._lock:
+            self._pending.pop(user_id, None)
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._ops
+
+    def flush(self) -> None:
+        with self.flush_lock:
+            with self._lock:
+                batch, self._pending, self._ops = self._pending, {}, 0
+                self._queued.clear()
+            if not batch:
+                return
+            rows = [
+                (user_id, key, op)
+                for user_id, ops in batch.items()
+                for key, op in ops.items()
+            ]
+            db = _connect(self.path)
+            try:
+                with db:
+                    _write_cart_ops(db, rows)
+            except sqlite3.Error:
+                logger.exception("Cart flush failed, requeueing %d changes", len(rows))
+                self._requeue(batch)
+
+    def _requeue(self, batch: Dict[int, Dict[str, _CartOp]]) -> None:
+        with self._lock:
+            self._queued.set()
+            for user_id, ops in batch.items():
+                newer = self._pending.get(user_id, {})
+                for key, op in ops.items():
+                    if key in newer:
+                        op = _compose(op, newer[key])
+                    newer[key] = op
+                self._pending[user_id] = newer
+                self._ops += len(ops)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._queued.set()
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            # Idle until the first change is queued, then give the batch
+            # ``interval`` to fill up (or less, once ``max_ops`` are queued).
+            self._queued.wait()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+
+_write_behind: Dict[str, _CartWriteBehind] = {}
+
+
+def enable_cart_write_behind(
+    path: str = DB_PATH,
+    interval: float = CART_FLUSH_INTERVAL,
+    max_ops: int = CART_FLUSH_MAX_OPS,
+) -> None:
+    """Queue add/remove cart changes for ``path`` and write them in batches.
+
+    Changes are flushed every ``interval`` seconds or once ``max_ops`` are
+    queued, whichever comes first. :func:`get_cart` merges queued changes, so
+    callers see their own writes immediately.
+    """
+    if path in _write_behind:
+        return
+    _write_behind[path] = _CartWriteBehind(path, interval, max_ops)
+
+
+def disable_cart_write_behind(path: str = DB_PATH) -> None:
+    writer = _write_behind.pop(path, None)
+    if writer is not None:
+        writer.stop()
+
+
+def flush_cart_writes(path: str = DB_PATH) -> None:
+    writer = _write_behind.get(path)
+    if writer is not None:
+        writer.flush()
+
+
+@atexit.register
+def _flush_all_cart_writes() -> None:
+    for path in list(_write_behind):
+        disable_cart_write_behind(path)
+
+
+# ---------------------------------------------------------------------------
+# Cart cache
+# ---------------------------------------------------------------------------
+CART_CACHE_SIZE = 10000
+# Number of locks cart writes are spread over by user.
+CART_WRITE_STRIPES = 64
+
+
+class _CartCache:
+    """LRU cache of whole carts, kept current by the cart write functions."""
+
+    def __init__(self, max_users: int) -> None:
+        self.max_users = max_users
+        self.hits = 0
+        self.misses = 0
+        self._carts: "OrderedDict[Tuple[str, int], Dict[str, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Serialise each user's cart writes with their cache update so both
+        # happen in the same order. Striped by user, so a write stuck behind
+        # SQLite's lock does not hold up other users' carts.
+        self._write_locks = [threading.RLock() for _ in range(CART_WRITE_STRIPES)]
+        # Bumped by writes to carts that are not cached; a cart read from
+        # SQLite is only cached if no such write raced with the read.
+        self._generation = 0
+
+    def write_lock(self, path: str, user_id: int) -> "threading.RLock":
+        return self._write_locks[hash((path, user_id)) % len(self._write_locks)]
+
+    def get(self, path: str, user_id: int) -> Optional[List[Tuple[str, int]]]:
+        key = (path, user_id)
+        with self._lock:
+            items = self._carts.get(key)
+            if items is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._carts.move_to_end(key)
+            return sorted(items.items())
+
+    def token(self) -> int:
+        with self._lock:
+            return self._generation
+
+    def fill(self, path: str, user_id: int, rows: List[Tuple[str, int]], token: int) -> None:
+        key = (path, user_id)
+        with self._lock:
+            if token != self._generation or key in self._carts:
+                return
+            self._put(key, dict(rows))
+
+    def update(self, path: str, user_id: int, drug_key: str, op: _CartOp) -> None:
+        with self._lock:
+            items = self._carts.get((path, user_id))
+            if items is None:
+                self._generation += 1
+                return
+            quantity = _apply(items.pop(drug_key, 0), op)
+            if quantity > 0:
+                items[drug_key] = quantity
+
+    def reset(self, path: str, user_id: int) -> None:
+        with self._lock:
+            self._carts.pop((path, user_id), None)
+            self._put((path, user_id), {})
+
+    def resize(self, max_users: int) -> None:
+        with self._lock:
+            self.max_users = max_users
+            self._generation += 1
+            self._evict()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._carts),
+                "max_users": self.max_users,
+            }
+
+    def _put(self, key: Tuple[str, int], items: Dict[str, int]) -> None:
+        if self.max_users <= 0:
+            return
+        self._carts[key] = items
+        self._evict()
+
+    def _evict(self) -> None:
+        while len(self._carts) > max(self.max_users, 0):
+            self._carts.popitem(last=False)
+
+
+_cart_cache = _CartCache(CART_CACHE_SIZE)
+
+
+def configure_cart_cache(max_users: int) -> None:
+    """Limit the cart cache to ``max_users`` carts; ``0`` disables it."""
+    _cart_cache.resize(max_users)
+
+
+def cart_write_behind_depth(path: str = DB_PATH) -> int:
+    """Cart changes queued for ``path``; 0 without write-behind."""
+    writer = _write_behind.get(path)
+    return writer.depth() if writer else 0
+
+
+def cart_cache_stats() -> Dict[str, int]:
+    return _cart_cache.stats()
+
+
+@contextmanager
+def _cart_write(path: str, user_id: int) -> Iterator[None]:
+    """Serialise a statement that empties ``user_id``'s cart.
+
+    Queued changes made before it are superseded (the cart is cleared or
+    turned into an order), so they are dropped and the cached cart is reset.
+    """
+    writer = _write_behind.get(path)
+    with _cart_cache.write_lock(path, user_id):
+        if writer is None:
+            yield
+        else:
+            with writer.flush_lock:
+                writer.discard(user_id)
+                yield
+        _cart_cache.reset(path, user_id)
+
+
+def add_to_cart(user_id: int, drug_key: str, qty: int = 1, path: str = DB_PATH) -> None:
+    with _cart_cache.write_lock(path, user_id):
+        writer = _write_behind.get(path)
+        if writer is not None:
+            writer.push(user_id, drug_key, qty)
+        else:
+            with _connect(path) as db:
+                db.execute(
+                    "INSERT OR IGNORE INTO cart(user_id, drug_key, quantity) VALUES(?, ?, 0)",
+                    (user_id, drug_key),
+                )
+                db.execute(
+                    "UPDATE cart SET quantity = quantity + ? WHERE user_id = ? AND drug_key = ?",
+                    (qty, user_id, drug_key),
+                )
+                db.commit()
+        _cart_cache.update(path, user_id, drug_key, (qty, 0))
+
+
+def remove_from_cart(user_id: int, drug_key: str, qty: int = 1, path: str = DB_PATH) -> None:
+    with _cart_cache.write_lock(path, user_id):
+        writer = _write_behind.get(path)
+        if writer is not None:
+            writer.push(user_id, drug_key, -qty)
+        else:
+            with _connect(path) as db:
+                db.execute(
+                    "UPDATE cart SET quantity = quantity - ? WHERE user_id = ? AND drug_key = ?",
+                    (qty, user_id, drug_key),
+                )
+                db.execute(
+                    "DELETE FROM cart WHERE user_id = ? AND drug_key = ? AND quantity <= 0",
+                    (user_id, drug_key),
+                )
+                db.commit()
+        _cart_cache.update(path, user_id, drug_key, (-qty, 0))
+
+
+def clear_cart(user_id: int, path: str = DB_PATH) -> None:
+    with _cart_write(path, user_id), _connect(path) as db:
+        db.execute("DELETE FROM cart WHERE user_id = ?", (user_id,))
+        db.commit()
+
+
+def _read_cart(db: sqlite3.Connection, user_id: int) -> List[Tuple[str, int]]:
+    cur = db.execute(
+        "SELECT drug_key, quantity FROM cart WHERE user_id = ?",
+        (user_id,),
+    )
+    return cur.fetchall()
+
+
+def _load_cart(user_id: int, path: str) -> List[Tuple[str, int]]:
+    writer = _write_behind.get(path)
+    if writer is None:
+        with _connect(path) as db:
+            return _read_cart(db, user_id)
+    with writer.flush_lock:
+        pending = writer.pending(user_id)
+        with _connect(path) as db:
+            rows = _read_cart(db, user_id)
+    if not pending:
+        return rows
+    items = dict(rows)
+    for key, op in pending.items():
+        quantity = _apply(items.pop(key, 0), op)
+        if quantity > 0:
+            items[key] = quantity
+    return sorted(items.items())
+
+
+def get_cart(user_id: int, path: str = DB_PATH) -> List[Tuple[str, int]]:
+    cached = _cart_cache.get(path, user_id)
+    if cached is not None:
+        return cached
+    token = _cart_cache.token()
+    rows = _load_cart(user_id, path)
+    _cart_cache.fill(path, user_id, rows, token)
+    return rows
+
+
+def _record_order_stats(
+    db: sqlite3.Connection,
+    user_id: int,
+    items: List[Tuple[str, int]],
+    total: int,
+    created_at: str,
+    prices: Dict[str, int],
+) -> None:
+    """Add a new order to the rollups, in the transaction that inserts it."""
+    db.execute(
+        """INSERT INTO user_stats(user_id, orders, spent, last_order_at) VALUES (?, 1, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            orders = orders + 1,
+            spent = spent + excluded.spent,
+            last_order_at = excluded.last_order_at""",
+        (user_id, total, created_at),
+    )
+    day = created_at[:10]
+    db.executemany(
+        """INSERT INTO sales_daily(day, drug_key, units, revenue) VALUES (?, ?, ?, ?)
+        ON CONFLICT(day, drug_key) DO UPDATE SET
+            units = units + excluded.units,
+            revenue = revenue + excluded.revenue""",
+        [(day, key, qty, qty * (prices.get(key) or 0)) for key, qty in items],
+    )
+    db.execute(
+        """INSERT INTO orders_hourly(hour, orders, revenue) VALUES (?, 1, ?)
+        ON CONFLICT(hour) DO UPDATE SET
+            orders = orders + 1,
+            revenue = revenue + excluded.revenue""",
+        (created_at[:13], total),
+    )
+    db.execute(
+        """INSERT INTO stars_daily(day, spent) VALUES (?, ?)
+        ON CONFLICT(day) DO UPDATE SET spent = spent + excluded.spent""",
+        (day, total),
+    )
+
+
+def _insert_order(
+    db: sqlite3.Connection,
+    user_id: int,
+    items: List[Tuple[str, int]],
+    total: int,
+    fio: str,
+    address: str,
+    prices: Dict[str, int],
+) -> int:
+    created_at = datetime.utcnow().isoformat()
+    items_json = json.dumps(items, ensure_ascii=False)
+    cur = db.execute(
+        "INSERT INTO orders(user_id, items, total, fio, address, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, items_json, total, fio, address, created_at),
+    )
+    db.executemany(
+        "INSERT INTO order_items(order_id, drug_key, quantity, price) VALUES (?, ?, ?, ?)",
+        [(cur.lastrowid, key, qty, prices.get(key)) for key, qty in items],
+    )
+    _record_order_stats(db, user_id, items, total, created_at, prices)
+    db.execute("DELETE FROM cart WHERE user_id = ?", (user_id,))
+    return cur.lastrowid
 
 
 def create_order(
@@ -118,20 +1014,78 @@ def create_order(
     fio: str,
     address: str,
     path: str = DB_PATH,
+    prices: Optional[Dict[str, int]] = None,
 ) -> None:
-    created_at = datetime.utcnow().isoformat()
-    items_json = json.dumps(items, ensure_ascii=False)
-    with _connect(path) as db:
-        db.execute(
-            "INSERT INTO orders(user_id, items, total, fio, address, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-            (user_id, items_json, total, fio, address, created_at),
-        )
-        db.execute("DELETE FROM cart WHERE user_id = ?", (user_id,))
+    with _cart_write(path, user_id), _connect(path) as db:
+        _insert_order(db, user_id, items, total, fio, address, prices or {})
         db.commit()
 
 
+CHECKOUT_OK = "ok"
+CHECKOUT_EMPTY = "empty"
+CHECKOUT_INSUFFICIENT = "insufficient"
+
+
+class CheckoutResult(NamedTuple):
+    status: str
+    items: List[Tuple[str, int]]
+    total: int
+    # Balance after the purchase, or the current balance if it failed.
+    stars: int
+    order_id: Optional[int] = None
+
+
+def checkout(user_id: int, fio: str, address: str, path: str = DB_PATH) -> CheckoutResult:
+    """Turn the user's cart into an order in one ``BEGIN IMMEDIATE`` transaction.
+
+    The cart is read and priced from ``products`` (hidden products are left
+    out), the balance is checked and debited, the order is inserted and the
+    cart cleared, all under SQLite's write lock, so concurrent checkouts by
+    the same user cannot spend the same stars twice.
+    """
+    writer = _write_behind.get(path)
+    with _cart_cache.write_lock(path, user_id), (writer.flush_lock if writer else nullcontext()):
+        pending = writer.pending(user_id) if writer else {}
+        db = _connect(path)
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if pending:
+                _write_cart_ops(db, [(user_id, key, op) for key, op in pending.items()])
+            rows = db.execute(
+                """SELECT c.drug_key, c.quantity, p.price
+                FROM cart c JOIN products p ON p.key = c.drug_key AND p.active = 1
+                WHERE c.user_id = ? ORDER BY c.drug_key""",
+                (user_id,),
+            ).fetchall()
+            items = [(key, qty) for key, qty, _ in rows]
+            prices = {key: price for key, _, price in rows}
+            total = sum(qty * price for _, qty, price in rows)
+            row = db.execute("SELECT stars FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            stars = row[0] if row else 0
+            if not items:
+                db.rollback()
+                return CheckoutResult(CHECKOUT_EMPTY, items, total, stars)
+            if stars < total:
+                db.rollback()
+                return CheckoutResult(CHECKOUT_INSUFFICIENT, items, total, stars)
+            db.execute(
+                "UPDATE users SET stars = stars - ? WHERE user_id = ?",
+                (total, user_id),
+            )
+            order_id = _insert_order(db, user_id, items, total, fio, address, prices)
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        if writer:
+            writer.discard(user_id)
+        _cart_cache.reset(path, user_id)
+    return CheckoutResult(CHECKOUT_OK, items, total, stars - total, order_id)
+
+
 def get_orders(user_id: int, path: str = DB_PATH) -> List[Dict[str, object]]:
     with _connect(path) as db:
+        # Walks idx_orders_user_created backwards, no scan or sort.
         cur = db.execute(
             "SELECT * FROM orders WHERE user_id = ? ORDER BY created_at DESC",
             (user_id,),
@@ -140,18 +1094,97 @@ def get_orders(user_id: int, path: str = DB_PATH) -> List[Dict[str, object]]:
         return [dict(zip(columns, row)) for row in cur.fetchall()]
 
 
-def export_orders(path: str = DB_PATH, dest: str = "orders.csv") -> str:
-    with _connect(path) as db:
-        cur = db.execute("SELECT * FROM orders")
-        rows = cur.fetchall()
-        columns = [c[0] for c in cur.description]
-    import csv
+class UserStats(NamedTuple):
+    orders: int = 0
+    spent: int = 0
+    last_order_at: Optional[str] = None
+
+
+def get_user_stats(user_id: int, path: str = DB_PATH) -> UserStats:
+    row = _connect(path).execute(
+        "SELECT orders, spent, last_order_at FROM user_stats WHERE user_id = ?",
+        (user_id,),
+    ).fetchone()
+    return UserStats(*row) if row else UserStats()
+
+
+_export_lock = threading.Lock()
+
+
+@contextmanager
+def _export_file_lock(dest: str) -> Iterator[None]:
+    """Serialise exports to ``dest`` across threads and, where ``fcntl`` is
+    available, across processes sharing the file (``python workers.py``)."""
+    with _export_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(dest + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
 
-    with open(dest, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(columns)
-        for row in rows:
-            writer.writerow(row)
+
+def export_orders(
+    path: str = DB_PATH,
+    dest: str = "orders.csv",
+    compress: bool = False,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+) -> str:
+    """Write all orders to the CSV file ``dest`` and return its name.
+
+    The file is maintained incrementally: ``export_state`` remembers the last
+    exported order id (the watermark) and the file size, so later calls only
+    append orders created since then and return the file untouched when there
+    are none. The file is rebuilt if it was removed or modified. Rows are
+    streamed from the cursor in ``chunk_size`` batches. With ``compress`` the
+    file is gzip'ed (``.gz`` is appended to ``dest``); appends add new gzip
+    members, which gzip readers concatenate transparently.
+    """
+    if compress and not dest.endswith(".gz"):
+        dest += ".gz"
+    key = os.path.abspath(dest)
+    with _export_file_lock(dest):
+        db = _connect(path)
+        cur = db.execute("SELECT * FROM orders LIMIT 0")
+        columns = json.dumps([c[0] for c in cur.description])
+        state = db.execute(
+            "SELECT last_id, size, columns FROM export_state WHERE dest = ?",
+            (key,),
+        ).fetchone()
+        fresh = (
+            state is None
+            or state[2] != columns
+            or not os.path.exists(dest)
+            or os.path.getsize(dest) != state[1]
+        )
+        last_id = 0 if fresh else state[0]
+        if not fresh:
+            latest = db.execute("SELECT MAX(id) FROM orders").fetchone()[0] or 0
+            if latest <= last_id:
+                return dest
+
+        mode = "wt" if fresh else "at"
+        opener = gzip.open if compress else open
+        with opener(dest, mode, newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            if fresh:
+                writer.writerow(json.loads(columns))
+            cur = db.execute("SELECT * FROM orders WHERE id > ? ORDER BY id", (last_id,))
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                writer.writerows(rows)
+                last_id = rows[-1][0]
+
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO export_state(dest, last_id, size, columns) VALUES (?, ?, ?, ?)",
+                (key, last_id, os.path.getsize(dest), columns),
+            )
     return dest
 
 
@@ -159,3 +1192,422 @@ def list_users(path: str = DB_PATH) -> List[int]:
     with _connect(path) as db:
         cur = db.execute("SELECT user_id FROM users")
         return [r[0] for r in cur.fetchall()]
+
+
+class Page(NamedTuple):
+    rows: List[Tuple]
+    # Cursors for the neighbouring pages: pass ``before=prev`` or
+    # ``after=next`` to fetch them; None if there is no such page.
+    prev: Optional[int]
+    next: Optional[int]
+
+
+def _keyset_page(
+    db: sqlite3.Connection,
+    select: str,
+    where: List[str],
+    params: List[object],
+    key: str,
+    descending: bool,
+    after: Optional[int],
+    before: Optional[int],
+    limit: int,
+    filters: Sequence[str] = (),
+    filter_params: Sequence[object] = (),
+    scan: Optional[int] = None,
+) -> Page:
+    """Fetch one page of ``select`` ordered by ``key`` (its first column).
+
+    Pages are addressed by the key of the row they continue from rather than
+    by an offset, so every page is a single range scan over the key's index
+    that reads ``limit + 1`` rows, however deep into the table it is.
+
+    ``filters`` are conditions no index serves. With ``scan`` the page looks
+    at no more than ``scan`` rows of the range: when fewer than ``limit``
+    of them pass the filters, a shorter (possibly empty) page is returned
+    whose cursor continues after the last row looked at.
+    """
+    backward = before is not None
+    cursor = before if backward else after
+    if descending != backward:
+        op, order = "<", "DESC"
+    else:
+        op, order = ">", "ASC"
+    where = list(where)
+    params = list(params)
+    if cursor is not None:
+        where.append(f"{key} {op} ?")
+        params.append(cursor)
+    boundary = None
+    if scan is not None and filters:
+        source = select[select.index(" FROM "):]
+        row = db.execute(
+            f"SELECT {key}{source} WHERE {' AND '.join(where) or '1'} ORDER BY {key} {order} LIMIT 1 OFFSET ?",
+            params + [scan - 1],
+        ).fetchone()
+        if row is not None:
+            boundary = row[0]
+            where.append(f"{key} {'>' if op == '<' else '<'}= ?")
+            params.append(boundary)
+    where += filters
+    params += filter_params
+    sql = f"{select} WHERE {' AND '.join(where) or '1'} ORDER BY {key} {order} LIMIT ?"
+    rows = db.execute(sql, params + [limit + 1]).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+        prev = rows[0][0] if more else boundary
+        return Page(rows, prev, rows[-1][0] if rows else before)
+    prev = (rows[0][0] if rows else cursor) if cursor is not None else None
+    return Page(rows, prev, rows[-1][0] if more else boundary)
+
+
+def list_users_page(
+    after: Optional[int] = None,
+    before: Optional[int] = None,
+    limit: int = ADMIN_PAGE_SIZE,
+    path: str = DB_PATH,
+) -> Page:
+    """A page of ``(user_id, stars)`` rows in user id order."""
+    return _keyset_page(
+        _connect(path), "SELECT user_id, stars FROM users", [], [],
+        "user_id", False, after, before, limit,
+    )
+
+
+def list_orders_page(
+    after: Optional[int] = None,
+    before: Optional[int] = None,
+    limit: int = ADMIN_PAGE_SIZE,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    min_total: Optional[int] = None,
+    path: str = DB_PATH,
+) -> Page:
+    """A page of ``(id, user_id, total, created_at)`` rows, newest first.
+
+    ``date_from`` and ``date_to`` are ISO dates; orders created on or after
+    ``date_from`` and before ``date_to`` are returned. Order ids grow with
+    ``created_at``, so the date range is turned into an id range with two
+    lookups in ``idx_orders_created`` and the page itself stays a rowid range
+    scan. The dates and ``min_total`` are still checked per row (the unary
+    ``+`` keeps the planner off the date index), so a clock that went
+    backwards cannot leak orders from outside the range. No index serves
+    ``min_total``, so a page with it set reads at most ``ORDERS_SCAN_LIMIT``
+    orders and may come back short; its cursor continues the scan.
+    """
+    where: List[str] = []
+    params: List[object] = []
+    if date_from:
+        where.append(
+            "id >= (SELECT id FROM orders WHERE created_at >= ? ORDER BY created_at LIMIT 1)"
+        )
+        where.append("+created_at >= ?")
+        params += [date_from, date_from]
+    if date_to:
+        where.append(
+            "id <= (SELECT id FROM orders WHERE created_at < ? ORDER BY created_at DESC LIMIT 1)"
+        )
+        where.append("+created_at < ?")
+        params += [date_to, date_to]
+    filters: List[str] = []
+    filter_params: List[object] = []
+    if min_total is not None:
+        filters.append("total >= ?")
+        filter_params.append(min_total)
+    return _keyset_page(
+        _connect(path), "SELECT id, user_id, total, created_at FROM orders", where, params,
+        "id", True, after, before, limit, filters, filter_params, ORDERS_SCAN_LIMIT,
+    )
+
+
+def list_user_orders_page(
+    user_id: int,
+    after: Optional[int] = None,
+    before: Optional[int] = None,
+    limit: int = HISTORY_PAGE_SIZE,
+    path: str = DB_PATH,
+) -> Page:
+    """A page of the user's orders, newest first.
+
+    Rows are ``(id, total, created_at, items)`` with ``items`` a list of
+    ``(drug_key, quantity)`` read from ``order_items`` for the page's orders
+    only.
+    """
+    db = _connect(path)
+    page = _keyset_page(
+        db, "SELECT id, total, created_at FROM orders", ["user_id = ?"], [user_id],
+        "id", True, after, before, limit,
+    )
+    if not page.rows:
+        return page
+    ids = [row[0] for row in page.rows]
+    items: Dict[int, List[Tuple[str, int]]] = {order_id: [] for order_id in ids}
+    for order_id, key, qty in db.execute(
+        f"""SELECT order_id, drug_key, quantity FROM order_items
+        WHERE order_id IN ({",".join("?" * len(ids))})""",
+        ids,
+    ):
+        items[order_id].append((key, qty))
+    return page._replace(rows=[row + (items[row[0]],) for row in page.rows])
+
+
+# ---------------------------------------------------------------------------
+# Analytics
+# ---------------------------------------------------------------------------
+def _rebuild_sales_stats(db: sqlite3.Connection, chunk_size: int = EXPORT_CHUNK_SIZE) -> int:
+    """Recompute the order aggregates from ``orders`` in one pass.
+
+    Orders and their items are streamed in id order and summed in memory
+    (one entry per day and product, or per hour), then the tables are
+    replaced. Items of orders placed before prices were recorded are valued
+    at the product's current price. Issued stars are not derived from orders
+    and are kept. Call inside a transaction. Returns the number of orders
+    read.
+    """
+    sales: Dict[Tuple[str, str], List[int]] = {}
+    hourly: Dict[str, List[int]] = {}
+    spent: Dict[str, int] = {}
+    count = 0
+    last_id = None
+    cur = db.execute(
+        """SELECT o.id, o.created_at, o.total, i.drug_key, i.quantity, COALESCE(i.price, p.price)
+        FROM orders o
+        LEFT JOIN order_items i ON i.order_id = o.id
+        LEFT JOIN products p ON p.key = i.drug_key
+        ORDER BY o.id"""
+    )
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            break
+        for order_id, created_at, total, key, qty, price in rows:
+            created_at = created_at or ""
+            day = created_at[:10]
+            if order_id != last_id:
+                last_id = order_id
+                count += 1
+                hour = hourly.setdefault(created_at[:13], [0, 0])
+                hour[0] += 1
+                hour[1] += total or 0
+                spent[day] = spent.get(day, 0) + (total or 0)
+            if key is not None:
+                line = sales.setdefault((day, key), [0, 0])
+                line[0] += qty
+                line[1] += qty * (price or 0)
+    db.execute("DELETE FROM sales_daily")
+    db.execute("DELETE FROM orders_hourly")
+    db.execute("UPDATE stars_daily SET spent = 0")
+    db.executemany(
+        "INSERT INTO sales_daily(day, drug_key, units, revenue) VALUES (?, ?, ?, ?)",
+        [(day, key, units, revenue) for (day, key), (units, revenue) in sales.items()],
+    )
+    db.executemany(
+        "INSERT INTO orders_hourly(hour, orders, revenue) VALUES (?, ?, ?)",
+        [(hour, orders, revenue) for hour, (orders, revenue) in hourly.items()],
+    )
+    db.executemany(
+        """INSERT INTO stars_daily(day, spent) VALUES (?, ?)
+        ON CONFLICT(day) DO UPDATE SET spent = excluded.spent""",
+        list(spent.items()),
+    )
+    db.execute("DELETE FROM stars_daily WHERE issued = 0 AND spent = 0")
+    return count
+
+
+def rebuild_sales_stats(path: str = DB_PATH) -> int:
+    """Rebuild the aggregates behind :func:`sales_report`; returns the order count.
+
+    Runs under ``BEGIN IMMEDIATE`` so no order is created halfway through.
+    """
+    db = _connect(path)
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        count = _rebuild_sales_stats(db)
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
+    return count
+
+
+class SalesReport(NamedTuple):
+    # (day, orders, revenue), oldest first.
+    days: List[Tuple[str, int, int]]
+    # (drug_key, units, revenue), best selling first.
+    top: List[Tuple[str, int, int]]
+    # (hour of day, orders), busiest first.
+    hours: List[Tuple[int, int]]
+    issued: int
+    spent: int
+
+
+def sales_report(days: int = 7, top: int = 5, path: str = DB_PATH) -> SalesReport:
+    """Sales over the last ``days`` days (UTC, today included), from the aggregates.
+
+    Reads at most ``days`` × (24 + number of products) aggregate rows, however
+    many orders there are.
+    """
+    since = (datetime.utcnow().date() - timedelta(days=days - 1)).isoformat()
+    db = _connect(path)
+    daily = db.execute(
+        """SELECT substr(hour, 1, 10) AS day, SUM(orders), SUM(revenue)
+        FROM orders_hourly WHERE hour >= ? GROUP BY day ORDER BY day""",
+        (since,),
+    ).fetchall()
+    best = db.execute(
+        """SELECT drug_key, SUM(units), SUM(revenue) AS total
+        FROM sales_daily WHERE day >= ?
+        GROUP BY drug_key ORDER BY total DESC, SUM(units) DESC LIMIT ?""",
+        (since, top),
+    ).fetchall()
+    hours = db.execute(
+        """SELECT CAST(substr(hour, 12, 2) AS INTEGER) AS h, SUM(orders) AS n
+        FROM orders_hourly WHERE hour >= ? GROUP BY h ORDER BY n DESC, h""",
+        (since,),
+    ).fetchall()
+    issued, spent = db.execute(
+        "SELECT COALESCE(SUM(issued), 0), COALESCE(SUM(spent), 0) FROM stars_daily WHERE day >= ?",
+        (since,),
+    ).fetchone()
+    return SalesReport(daily, best, hours, issued, spent)
+
+
+# ---------------------------------------------------------------------------
+# Broadcasts
+# ---------------------------------------------------------------------------
+BROADCAST_RUNNING = "running"
+BROADCAST_DONE = "done"
+BROADCAST_CANCELLED = "cancelled"
+
+RECIPIENT_PENDING = "pending"
+RECIPIENT_SENT = "sent"
+RECIPIENT_FAILED = "failed"
+RECIPIENT_BLOCKED = "blocked"
+
+
+class Broadcast(NamedTuple):
+    id: int
+    text: str
+    chat_id: int
+    status: str
+    total: int
+    sent: int
+    failed: int
+    blocked: int
+    created_at: str
+    finished_at: Optional[str]
+
+
+# (user_id, status, attempts, next_at, error)
+RecipientResult = Tuple[int, str, int, float, Optional[str]]
+
+
+def create_broadcast(text: str, chat_id: int, path: str = DB_PATH) -> Broadcast:
+    """Queue ``text`` for every user who has not blocked the bot.
+
+    ``chat_id`` is where progress is reported.
+    """
+    db = _connect(path)
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        cur = db.execute(
+            "INSERT INTO broadcasts(text, chat_id, status, created_at) VALUES (?, ?, ?, ?)",
+            (text, chat_id, BROADCAST_RUNNING, datetime.utcnow().isoformat()),
+        )
+        broadcast_id = cur.lastrowid
+        total = db.execute(
+            """INSERT INTO broadcast_recipients(broadcast_id, user_id)
+            SELECT ?, user_id FROM users WHERE blocked = 0""",
+            (broadcast_id,),
+        ).rowcount
+        db.execute("UPDATE broadcasts SET total = ? WHERE id = ?", (total, broadcast_id))
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
+    return get_broadcast(broadcast_id, path)
+
+
+def get_broadcast(broadcast_id: int, path: str = DB_PATH) -> Optional[Broadcast]:
+    row = _connect(path).execute(
+        "SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)
+    ).fetchone()
+    return Broadcast(*row) if row else None
+
+
+def running_broadcasts(path: str = DB_PATH) -> List[Broadcast]:
+    rows = _connect(path).execute(
+        "SELECT * FROM broadcasts WHERE status = ? ORDER BY id", (BROADCAST_RUNNING,)
+    ).fetchall()
+    return [Broadcast(*row) for row in rows]
+
+
+def broadcast_batch(
+    broadcast_id: int, now: float, limit: int, path: str = DB_PATH
+) -> List[Tuple[int, int]]:
+    """Up to ``limit`` ``(user_id, attempts)`` pairs that are due by ``now``."""
+    return _connect(path).execute(
+        """SELECT user_id, attempts FROM broadcast_recipients
+        WHERE broadcast_id = ? AND status = 'pending' AND next_at <= ?
+        ORDER BY next_at LIMIT ?""",
+        (broadcast_id, now, limit),
+    ).fetchall()
+
+
+def next_broadcast_retry(broadcast_id: int, path: str = DB_PATH) -> Optional[float]:
+    """When the earliest pending recipient is due; None if none are left."""
+    row = _connect(path).execute(
+        """SELECT next_at FROM broadcast_recipients
+        WHERE broadcast_id = ? AND status = 'pending'
+        ORDER BY next_at LIMIT 1""",
+        (broadcast_id,),
+    ).fetchone()
+    return row[0] if row else None
+
+
+def record_broadcast_results(
+    broadcast_id: int, results: List[RecipientResult], path: str = DB_PATH
+) -> None:
+    """Store the outcome of a batch of sends and update the job's counters.
+
+    Recipients who blocked the bot are also flagged in ``users`` so later
+    broadcasts skip them.
+    """
+    counts = Counter(status for _, status, _, _, _ in results)
+    with _connect(path) as db:
+        db.executemany(
+            """UPDATE broadcast_recipients SET status = ?, attempts = ?, next_at = ?, error = ?
+            WHERE broadcast_id = ? AND user_id = ?""",
+            [
+                (status, attempts, next_at, error, broadcast_id, user_id)
+                for user_id, status, attempts, next_at, error in results
+            ],
+        )
+        db.executemany(
+            "UPDATE users SET blocked = 1 WHERE user_id = ?",
+            [(user_id,) for user_id, status, _, _, _ in results if status == RECIPIENT_BLOCKED],
+        )
+        db.execute(
+            """UPDATE broadcasts SET sent = sent + ?, failed = failed + ?, blocked = blocked + ?
+            WHERE id = ?""",
+            (
+                counts[RECIPIENT_SENT],
+                counts[RECIPIENT_FAILED],
+                counts[RECIPIENT_BLOCKED],
+                broadcast_id,
+            ),
+        )
+        db.commit()
+
+
+def finish_broadcast(broadcast_id: int, status: str, path: str = DB_PATH) -> bool:
+    """Mark a running broadcast done or cancelled; False if it was not running."""
+    with _connect(path) as db:
+        cur = db.execute(
+            "UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ? AND status = ?",
+            (status, datetime.utcnow().isoformat(), broadcast_id, BROADCAST_RUNNING),
+        )
+        db.commit()
+        return cur.rowcount > 0
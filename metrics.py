@@ -0,0 +1,346 @@
+import bisect
+import functools
+import logging
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlparse
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_STACKS = 2000
+
+Labels = Tuple[str, ...]
+
+
+def _format_labels(names: Labels, values: Labels, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Labels = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[values] = self._values.get(values, 0.0) + amount
+
+    def expose(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, value in items:
+            yield f"{self.name}{_format_labels(self.labels, values)} {_number(value)}"
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram, one series per label set."""
+
+    def __init__(self, name: str, help: str, labels: Labels = (), buckets: Tuple[float, ...] = BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Per label set: bucket counts (last one is +Inf), sum.
+        self._series: Dict[Labels, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, *values: str) -> None:
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += seconds
+
+    def expose(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = sorted((k, (list(c), s[0])) for k, (c, s) in self._series.items())
+        for values, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(self.labels, values, 'le="' + le + '"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, values)} {total!r}"
+            yield f"{self.name}_count{_format_labels(self.labels, values)} {cumulative}"
+
+
+GaugeValue = Union[float, Dict[Labels, float]]
+
+
+class Gauge:
+    """Value read from ``read()`` at scrape time.
+
+    ``read`` returns a number, or a dict of label values to numbers.
+    """
+
+    def __init__(self, name: str, help: str, read: Callable[[], GaugeValue], labels: Labels = (), kind: str = "gauge") -> None:
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labels = labels
+        self.kind = kind
+
+    def expose(self) -> Iterator[str]:
+        try:
+            value = self.read()
+        except Exception:
+            logger.warning("Could not read metric %s", self.name, exc_info=True)
+            return
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for values, number in sorted(items):
+            yield f"{self.name}{_format_labels(self.labels, values)} {_number(number)}"
+
+
+class SlowProfiler:
+    """Samples the stacks of calls that run longer than ``threshold`` seconds.
+
+    Timed calls register their thread while they run. A sampler thread
+    wakes every ``interval`` seconds, and for each call that has been
+    running for at least ``threshold`` takes its thread's current stack
+    from ``sys._current_frames()``. Samples are tallied per call name and
+    stack and reported in the folded format flame graph tools read
+    (``name;outer;...;inner count``). Fast calls cost one dict update.
+    """
+
+    def __init__(self, threshold: float = 0.0, interval: float = PROFILE_INTERVAL, max_stacks: int = PROFILE_MAX_STACKS) -> None:
+        self.threshold = threshold
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self._active: Dict[int, Tuple[str, float]] = {}
+        self._stacks: "_Tally[str]" = _Tally()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._running = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return self._running.is_set()
+
+    def enable(self, threshold: Optional[float] = None) -> None:
+        if threshold is not None:
+            self.threshold = threshold
+        self._running.set()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="slow-profiler", daemon=True)
+            self._thread.start()
+
+    def disable(self) -> None:
+        self._running.clear()
+        with self._lock:
+            self._active.clear()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stacks.clear()
+
+    def enter(self, name: str) -> Optional[Tuple[str, float]]:
+        """Start tracking a call; pass the result to :meth:`exit`."""
+        ident = threading.get_ident()
+        outer = self._active.get(ident)
+        self._active[ident] = (name, time.monotonic())
+        return outer
+
+    def exit(self, outer: Optional[Tuple[str, float]]) -> None:
+        ident = threading.get_ident()
+        if outer is None:
+            self._active.pop(ident, None)
+        else:
+            # Back in the enclosing tracked call.
+            self._active[ident] = outer
+
+    def folded(self) -> str:
+        with self._lock:
+            lines = [f"{stack} {count}" for stack, count in self._stacks.most_common()]
+        return "\n".join(lines) + ("\n" if lines else "")
+
+    def _run(self) -> None:
+        while self._running.is_set():
+            time.sleep(self.interval)
+            now = time.monotonic()
+            slow = [
+                (ident, name)
+                for ident, (name, started) in list(self._active.items())
+                if now - started >= self.threshold
+            ]
+            if not slow:
+                continue
+            frames = sys._current_frames()
+            for ident, name in slow:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                parts = []
+                while frame is not None:
+                    code = frame.f_code
+                    parts.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                stack = ";".join([name] + parts[::-1])
+                with self._lock:
+                    if stack in self._stacks or len(self._stacks) < self.max_stacks:
+                        self._stacks[stack] += 1
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: List[Any] = []
+        self.profiler = SlowProfiler()
+
+    def counter(self, name: str, help: str, labels: Labels = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Labels = ()) -> Histogram:
+        metric = Histogram(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help: str, read: Callable[[], GaugeValue], labels: Labels = (), kind: str = "gauge") -> Gauge:
+        metric = Gauge(name, help, read, labels, kind)
+        self.metrics.append(metric)
+        return metric
+
+    def timed(self, fn: Callable[..., Any], label: str, latency: Histogram, errors: Counter, profile: bool = False) -> Callable[..., Any]:
+        """Wrap ``fn`` to record its latency and exceptions under ``label``.
+
+        With ``profile`` the call is also visible to :attr:`profiler` while
+        it runs.
+        """
+        profiler = self.profiler
+
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            tracked = profile and profiler.enabled
+            outer = profiler.enter(label) if tracked else None
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except BaseException:
+                errors.inc(label)
+                raise
+            finally:
+                latency.observe(time.perf_counter() - started, label)
+                if tracked:
+                    profiler.exit(outer)
+
+        wrapper.__wrapped_by_metrics__ = True  # type: ignore[attr-defined]
+        return wrapper
+
+    def instrument_module(self, module: Any, latency: Histogram, errors: Counter) -> None:
+        """Time every public function defined in ``module``.
+
+        The wrappers replace the module globals, so calls between functions
+        inside the module (``create_broadcast`` calling ``get_broadcast``) are
+        timed too, and the outer call's time includes the inner one.
+        """
+        for name, fn in list(vars(module).items()):
+            if name.startswith("_") or not callable(fn) or isinstance(fn, type):
+                continue
+            if getattr(fn, "__module__", None) != module.__name__:
+                continue
+            if getattr(fn, "__wrapped_by_metrics__", False):
+                continue
+            setattr(module, name, self.timed(fn, name, latency, errors))
+
+    def expose(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class MetricsServer:
+    """Serves ``registry`` in the Prometheus text format on ``/metrics``.
+
+    ``/profile`` returns the slow-call profile in folded format;
+    ``/profile?enable=<ms>``, ``?disable=1`` and ``?reset=1`` control it.
+    """
+
+    def __init__(self, registry: Registry = registry, host: str = "127.0.0.1", port: int = 9100) -> None:
+        self.registry = registry
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+        self._thread.start()
+        logger.info("Metrics on http://%s:%d/metrics", *self._server.server_address[:2])
+
+    def shutdown(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self) -> type:
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                url = urlparse(self.path)
+                if url.path == "/metrics":
+                    self._reply(200, registry.expose(), "text/plain; version=0.0.4; charset=utf-8")
+                elif url.path == "/profile":
+                    query = parse_qs(url.query)
+                    profiler = registry.profiler
+                    try:
+                        if "enable" in query:
+                            profiler.enable(float(query["enable"][0]) / 1000)
+                    except ValueError:
+                        self._reply(400, "enable expects milliseconds\n")
+                        return
+                    if "disable" in query:
+                        profiler.disable()
+                    if "reset" in query:
+                        profiler.reset()
+                    state = f"# enabled={profiler.enabled} threshold_ms={profiler.threshold * 1000:g}\n"
+                    self._reply(200, state + profiler.folded())
+                else:
+                    self._reply(404, "not found\n")
+
+            def _reply(self, status: int, body: str, content_type: str = "text/plain; charset=utf-8") -> None:
+                data = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                logger.debug(format, *args)
+
+        return Handler
@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+from collections import Counter, deque
+from typing import Callable, Deque, Iterable, List, Optional, Tuple
+
+from telebot.apihelper import ApiTelegramException
+
+
+logger = logging.getLogger(__name__)
+
+DIGEST_INTERVAL = 10.0
+QUEUE_SIZE = 1000
+MAX_RETRIES = 5
+# Telegram rejects messages longer than this.
+MESSAGE_LIMIT = 4096
+
+
+class NotificationDispatcher:
+    """Delivers admin notifications from background worker threads.
+
+    :meth:`submit` never blocks the caller. Urgent messages (new orders) are
+    sent to every admin as soon as a worker picks them up; digest messages
+    ("user added X") are collected and sent as one summary per admin every
+    ``digest_interval`` seconds. The queue holds at most ``max_queue``
+    messages: when it is full the oldest queued message is dropped and the
+    number of dropped messages is reported in the next digest. Telegram 429
+    responses are retried after the ``retry_after`` the API asks for.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[int, str], object],
+        admin_ids: Iterable[int],
+        digest_interval: float = DIGEST_INTERVAL,
+        max_queue: int = QUEUE_SIZE,
+        workers: int = 1,
+    ) -> None:
+        self.send = send
+        self.admin_ids = list(admin_ids)
+        self.digest_interval = digest_interval
+        self.max_queue = max_queue
+        self.workers = workers
+        self.dropped = 0
+        self.sent = 0
+        self._queue: Deque[Tuple[bool, str]] = deque()
+        self._digest: "Counter[str]" = Counter()
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._stopping = False
+        self._next_digest = time.monotonic() + digest_interval
+
+    def submit(self, text: str, digest: bool = False) -> None:
+        if not self.admin_ids:
+            return
+        with self._cond:
+            if not self._threads:
+                self._start()
+            if len(self._queue) >= self.max_queue:
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append((digest, text))
+            self._cond.notify()
+
+    def depth(self) -> int:
+        with self._cond:
+            return len(self._queue)
+
+    def stop(self, timeout: Optional[float] = 5.0) -> None:
+        """Deliver what is queued, send the pending digest and stop workers."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(timeout)
+        self._send_digest()
+        with self._cond:
+            self._stopping = False
+
+    def _start(self) -> None:
+        for number in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, name=f"notify-{number}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopping:
+                    timeout = self._next_digest - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if not self._queue and self._stopping:
+                    return
+                event = self._queue.popleft() if self._queue else None
+                digest_due = time.monotonic() >= self._next_digest
+                if digest_due:
+                    self._next_digest = time.monotonic() + self.digest_interval
+            if event is not None:
+                is_digest, text = event
+                if is_digest:
+                    with self._cond:
+                        self._digest[text] += 1
+                else:
+                    self._broadcast(text)
+            if digest_due:
+                self._send_digest()
+
+    def _send_digest(self) -> None:
+        with self._cond:
+            lines, self._digest = self._digest, Counter()
+            dropped, self.dropped = self.dropped, 0
+        if not lines and not dropped:
+            return
+        text = "\U0001F4CB Активность за последнее время:\n"
+        for number, (line, count) in enumerate(lines.items()):
+            entry = f"{line} × {count}\n" if count > 1 else f"{line}\n"
+            if len(text) + len(entry) > MESSAGE_LIMIT - 64:
+                text += f"… и ещё {len(lines) - number} событий\n"
+                break
+            text += entry
+        if dropped:
+            text += f"Пропущено уведомлений из-за переполнения очереди: {dropped}\n"
+        self._broadcast(text)
+
+    def _broadcast(self, text: str) -> None:
+        for admin_id in self.admin_ids:
+            self._deliver(admin_id, text)
+
+    def _deliver(self, admin_id: int, text: str) -> None:
+        delay = 1.0
+        for _ in range(MAX_RETRIES):
+            try:
+                self.send(admin_id, text)
+                self.sent += 1
+                return
+            except ApiTelegramException as e:
+                if e.error_code != 429:
+                    logger.warning("Admin %s notification rejected: %s", admin_id, e)
+                    return
+                params = (e.result_json or {}).get("parameters") or {}
+                time.sleep(params.get("retry_after", delay))
+            except Exception:
+                logger.warning("Admin %s notification failed, retrying", admin_id, exc_info=True)
+                time.sleep(delay)
+            delay *= 2
+        logger.error("Giving up on notification for admin %s", admin_id)
@@ -0,0 +1,78 @@
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+
+Handler = Callable[[Any, str], None]
+
+
+class Route(NamedTuple):
+    handler: Handler
+    validate: Optional[Callable[[str], bool]]
+
+
+class CallbackRouter:
+    """Maps callback data to handlers with dictionary lookups.
+
+    Callback data is ``<action>`` or ``<action>_<argument>``; actions may
+    contain underscores themselves (``admin_users``). Data is parsed once:
+    an exact match wins, otherwise the longest registered prefix ending
+    before an underscore is taken as the action and the rest as the
+    argument, so the cost depends on the length of the data, not on the
+    number of routes. Handlers receive ``(call, argument)``.
+    """
+
+    def __init__(self) -> None:
+        self._exact: Dict[str, Route] = {}
+        self._prefix: Dict[str, Route] = {}
+
+    def callback(
+        self,
+        action: str,
+        prefix: bool = False,
+        validate: Optional[Callable[[str], bool]] = None,
+    ) -> Callable[[Handler], Handler]:
+        """Register a handler for ``action``.
+
+        With ``prefix`` the handler also receives ``<action>_<argument>``.
+        ``validate`` rejects arguments that are no longer valid (a removed
+        product, say) before the handler runs.
+        """
+
+        def decorator(handler: Handler) -> Handler:
+            route = Route(handler, validate)
+            self._exact[action] = route
+            if prefix:
+                self._prefix[action] = route
+            return handler
+
+        return decorator
+
+    def map_handlers(self, wrap: Callable[[str, Handler], Handler]) -> None:
+        """Replace every handler by ``wrap(action, handler)``."""
+        for action, route in list(self._exact.items()):
+            wrapped = route._replace(handler=wrap(action, route.handler))
+            self._exact[action] = wrapped
+            if action in self._prefix:
+                self._prefix[action] = wrapped
+
+    def resolve(self, data: str) -> Optional[Tuple[Route, str]]:
+        route = self._exact.get(data)
+        if route is not None:
+            return route, ""
+        cut = data.rfind("_")
+        while cut > 0:
+            route = self._prefix.get(data[:cut])
+            if route is not None:
+                return route, data[cut + 1:]
+            cut = data.rfind("_", 0, cut)
+        return None
+
+    def dispatch(self, call: Any) -> bool:
+        """Run the handler for ``call.data``; False if it is unknown or stale."""
+        resolved = self.resolve(call.data or "")
+        if resolved is None:
+            return False
+        route, arg = resolved
+        if route.validate is not None and not route.validate(arg):
+            return False
+        route.handler(call, arg)
+        return True
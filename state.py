@@ -0,0 +1,197 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import db
+
+
+State = Dict[str, object]
+
+TTL = 3600.0
+MAX_HOT = 10000
+MAX_COLD = 100000
+# Expired entries dropped per operation, and operations between purges of
+# expired rows from SQLite.
+SWEEP_BATCH = 16
+PURGE_EVERY = 256
+# Locks serialising each user's reads and writes.
+USER_LOCK_STRIPES = 64
+
+
+class StateStore:
+    """Conversation state per user with expiry and a bounded memory footprint.
+
+    Every state is written through to the ``user_states`` table, so
+    unfinished checkouts survive a restart. At most ``max_hot`` states are
+    kept in memory; older ones are evicted to the cold tier, where only
+    their user id and expiry stay in memory (up to ``max_cold`` of them) and
+    the state itself is read back from SQLite on the next access. Users
+    without a state never cause a query.
+
+    States expire ``ttl`` seconds after they were last set. Expired entries
+    are swept a few at a time on every call instead of in one full scan:
+    both tiers are ordered by expiry, so the sweep only looks at the front.
+
+    When several processes share the table, each one serves a subset of the
+    users; ``partition=(index, count)`` makes the store load (and so evict)
+    only the states of users with ``user_id % count == index``.
+
+    SQLite is only touched outside the lock that guards the two tiers; each
+    user's operations are serialised by a per-user (striped) lock instead, so
+    a slow write for one user does not hold up lookups for the others.
+    """
+
+    def __init__(
+        self,
+        path: str = db.DB_PATH,
+        ttl: float = TTL,
+        max_hot: int = MAX_HOT,
+        max_cold: int = MAX_COLD,
+        partition: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        self.path = path
+        self.partition = partition
+        self.ttl = ttl
+        self.max_hot = max_hot
+        self.max_cold = max_cold
+        self._hot: "OrderedDict[int, Tuple[State, float]]" = OrderedDict()
+        self._cold: "OrderedDict[int, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._user_locks = [threading.Lock() for _ in range(USER_LOCK_STRIPES)]
+        self._loaded = False
+        self._ops = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._hot) + len(self._cold)
+
+    def preload(self) -> None:
+        """Read which users have live states now rather than on first use."""
+        self._load()
+
+    def cached_step(self, user_id: int, cold: object = None) -> Optional[object]:
+        """The user's ``step`` as far as memory knows, without SQLite or the lock.
+
+        Returns ``cold`` for states evicted to the cold tier, whose content is
+        only in the database. A state that expired may still be reported
+        until it is swept.
+        """
+        entry = self._hot.get(user_id)
+        if entry is not None:
+            return entry[0].get("step")
+        return cold if user_id in self._cold else None
+
+    def get(self, user_id: int) -> Optional[State]:
+        state = self._lookup(user_id)
+        return dict(state) if state is not None else None
+
+    def step(self, user_id: int) -> Optional[object]:
+        state = self._lookup(user_id)
+        return state.get("step") if state is not None else None
+
+    def set(self, user_id: int, state: State) -> None:
+        now = time.time()
+        expires_at = now + self.ttl
+        self._load()
+        with self._user_lock(user_id):
+            db.save_state(user_id, state, expires_at, self.path)
+            with self._lock:
+                purge = self._maintain(now)
+                self._cold.pop(user_id, None)
+                self._hot.pop(user_id, None)
+                self._hot[user_id] = (dict(state), expires_at)
+                evicted = self._evict()
+        self._write_back(now, purge, evicted)
+
+    def pop(self, user_id: int) -> None:
+        now = time.time()
+        self._load()
+        with self._user_lock(user_id):
+            with self._lock:
+                purge = self._maintain(now)
+                in_hot = self._hot.pop(user_id, None) is not None
+                in_cold = self._cold.pop(user_id, None) is not None
+            if in_hot or in_cold:
+                db.delete_state(user_id, self.path)
+        self._write_back(now, purge, [])
+
+    def _user_lock(self, user_id: int) -> threading.Lock:
+        return self._user_locks[hash(user_id) % len(self._user_locks)]
+
+    def _lookup(self, user_id: int) -> Optional[State]:
+        now = time.time()
+        self._load()
+        evicted: List[Tuple[int, float]] = []
+        with self._user_lock(user_id):
+            with self._lock:
+                purge = self._maintain(now)
+                entry = self._hot.get(user_id)
+                if entry is not None and entry[1] <= now:
+                    del self._hot[user_id]
+                    entry = None
+                cold = entry is None and self._cold.get(user_id, 0.0) > now
+            if cold:
+                entry = db.load_state(user_id, self.path)
+                if entry is not None and entry[1] <= now:
+                    entry = None
+                with self._lock:
+                    # The cold tier may have overflowed and dropped the user
+                    # while the state was being read.
+                    if self._cold.pop(user_id, None) is None:
+                        entry = None
+                    elif entry is not None:
+                        self._hot[user_id] = entry
+                        evicted = self._evict()
+        self._write_back(now, purge, evicted)
+        return entry[0] if entry is not None else None
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        with self._load_lock:
+            if self._loaded:
+                return
+            live = db.live_states(time.time(), self.max_cold, self.path, self.partition)
+            with self._lock:
+                self._cold.update(live)
+                self._loaded = True
+
+    def _maintain(self, now: float) -> bool:
+        """Sweep expired entries; True when expired rows are due to be purged."""
+        for _ in range(SWEEP_BATCH):
+            if not self._hot:
+                break
+            user_id, (_, expires_at) = next(iter(self._hot.items()))
+            if expires_at > now:
+                break
+            del self._hot[user_id]
+        for _ in range(SWEEP_BATCH):
+            if not self._cold:
+                break
+            user_id, expires_at = next(iter(self._cold.items()))
+            if expires_at > now:
+                break
+            del self._cold[user_id]
+        self._ops += 1
+        return self._ops % PURGE_EVERY == 0
+
+    def _evict(self) -> List[Tuple[int, float]]:
+        """Move overflow to the cold tier; returns the states dropped from it."""
+        while len(self._hot) > self.max_hot:
+            user_id, (_, expires_at) = self._hot.popitem(last=False)
+            self._cold[user_id] = expires_at
+            self._cold.move_to_end(user_id)
+        dropped = []
+        while len(self._cold) > self.max_cold:
+            dropped.append(self._cold.popitem(last=False))
+        return dropped
+
+    def _write_back(self, now: float, purge: bool, dropped: List[Tuple[int, float]]) -> None:
+        # Outside the store lock. A dropped user may have been set again
+        # meanwhile; matching expires_at leaves the new row alone.
+        for user_id, expires_at in dropped:
+            db.delete_state(user_id, self.path, expires_at)
+        if purge:
+            db.purge_states(now, SWEEP_BATCH * 8, self.path)
@@ -0,0 +1,190 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows roughly one message per second in a chat, with short bursts.
+CHAT_RATE = 1.0
+CHAT_BURST = 3
+MAX_CHATS = 10000
+WINDOW = 0.4
+
+
+class TokenBucket:
+    """Allows ``rate`` operations per second with bursts of ``capacity``."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, tokens: float = 1.0) -> float:
+        """Take ``tokens`` and return 0, or return the seconds to wait for them."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+
+class ChatRateLimiter:
+    """One :class:`TokenBucket` per chat, for the ``max_chats`` most recent chats."""
+
+    def __init__(self, rate: float = CHAT_RATE, burst: float = CHAT_BURST, max_chats: int = MAX_CHATS) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_chats = max_chats
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def delay(self, chat_id: Hashable) -> float:
+        with self._lock:
+            bucket = self._buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._buckets[chat_id] = TokenBucket(self.rate, self.burst)
+                if len(self._buckets) > self.max_chats:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(chat_id)
+        return bucket.take()
+
+
+class Coalescer:
+    """Collapses bursts of events per key into one ``flush(key, events)`` call.
+
+    The first event after a quiet period is flushed immediately, in the
+    caller's thread. Events arriving within ``window`` seconds of a flush are
+    collected and flushed together once the window has passed, on a small
+    worker pool. ``delay(key)`` may postpone a flush (e.g. when a rate limit
+    is exhausted); events keep accumulating meanwhile. At most one flush per
+    key runs at a time, so each key sees its events in order.
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[Hashable, List[Any]], None],
+        window: float = WINDOW,
+        delay: Optional[Callable[[Hashable], float]] = None,
+        workers: int = 2,
+    ) -> None:
+        self.flush = flush
+        self.window = window
+        self.delay = delay or (lambda key: 0.0)
+        self.workers = workers
+        self._pending: Dict[Hashable, List[Any]] = {}
+        self._quiet_until: "OrderedDict[Hashable, float]" = OrderedDict()
+        self._busy: Set[Hashable] = set()
+        self._scheduled: Dict[Hashable, float] = {}
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def depth(self) -> int:
+        with self._cond:
+            return sum(len(events) for events in self._pending.values())
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every pushed event has been flushed; False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._busy:
+                wait = 0.05
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        return False
+                self._cond.wait(wait)
+        return True
+
+    def discard(self, key: Hashable) -> None:
+        """Drop ``key``'s events that are not being flushed yet."""
+        with self._cond:
+            if self._pending.pop(key, None) is not None:
+                self._cond.notify_all()
+
+    def push(self, key: Hashable, event: Any) -> None:
+        now = time.monotonic()
+        with self._cond:
+            self._prune(now)
+            events = self._pending.get(key)
+            if events is not None:
+                events.append(event)
+                return
+            self._pending[key] = [event]
+            if key in self._busy or key in self._scheduled:
+                return
+            due = self._quiet_until.get(key, 0.0)
+            if due > now:
+                self._schedule(key, due)
+                return
+            events = self._claim(key, now)
+        if events is not None:
+            self._run(key, events)
+
+    def _claim(self, key: Hashable, now: float) -> Optional[List[Any]]:
+        """Take ``key``'s events for flushing; call with the lock held."""
+        wait = self.delay(key)
+        if wait > 0:
+            self._schedule(key, now + wait)
+            return None
+        self._busy.add(key)
+        self._quiet_until[key] = now + self.window
+        self._quiet_until.move_to_end(key)
+        return self._pending.pop(key)
+
+    def _schedule(self, key: Hashable, due: float) -> None:
+        self._scheduled[key] = due
+        heapq.heappush(self._heap, (due, next(self._seq), key))
+        if self._thread is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="coalesce")
+            self._thread = threading.Thread(target=self._loop, name="coalescer", daemon=True)
+            self._thread.start()
+        self._cond.notify()
+
+    def _run(self, key: Hashable, events: List[Any]) -> None:
+        try:
+            self.flush(key, events)
+        except Exception:
+            logger.exception("Flush of %d events for %s failed", len(events), key)
+        finally:
+            with self._cond:
+                self._busy.discard(key)
+                if key in self._pending and key not in self._scheduled:
+                    self._schedule(key, self._quiet_until.get(key, 0.0))
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+                due, _, key = heapq.heappop(self._heap)
+                if self._scheduled.get(key) != due:
+                    continue
+                del self._scheduled[key]
+                if key in self._busy or key not in self._pending:
+                    continue
+                events = self._claim(key, time.monotonic())
+            if events is not None:
+                self._executor.submit(self._run, key, events)
+
+    def _prune(self, now: float) -> None:
+        while self._quiet_until:
+            key, until = next(iter(self._quiet_until.items()))
+            if until > now or key in self._busy or key in self._pending:
+                break
+            del self._quiet_until[key]
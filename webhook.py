@@ -0,0 +1,149 @@
+import hmac
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+WORKERS = 4
+QUEUE_SIZE = 1000
+# Updates are a few KB; anything much larger is not from Telegram.
+MAX_BODY = 1 << 20
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+
+def check_secret(secret: Optional[str], host: str, url: Optional[str] = None) -> None:
+    """Refuse to expose the endpoint without a secret.
+
+    Without one, anyone who can reach it can post updates on behalf of any
+    user, admins included. Only a server that listens on loopback and is not
+    registered with Telegram may run without a secret.
+    """
+    if secret is None and (url or host not in LOOPBACK_HOSTS):
+        raise ValueError(
+            "WEBHOOK_SECRET is required when the webhook is registered (WEBHOOK_URL) "
+            "or listens on a non-loopback host"
+        )
+
+
+class WebhookServer:
+    """HTTP endpoint for Telegram webhook updates.
+
+    Every POST to ``path`` is checked against ``secret`` (Telegram sends it in
+    the ``X-Telegram-Bot-Api-Secret-Token`` header), parsed and put on a
+    bounded queue; the request is answered right away and ``process`` is
+    called with the update dict by one of ``workers`` threads. When the queue
+    is full the server answers 503 so Telegram redelivers the update later.
+    Bodies over ``MAX_BODY`` bytes are refused unread. A ``secret`` is
+    required unless ``host`` is a loopback address (see :func:`check_secret`).
+    """
+
+    def __init__(
+        self,
+        process: Callable[[Dict[str, Any]], None],
+        host: str = "0.0.0.0",
+        port: int = 8080,
+        path: str = "/webhook",
+        secret: Optional[str] = None,
+        workers: int = WORKERS,
+        queue_size: int = QUEUE_SIZE,
+    ) -> None:
+        check_secret(secret, host)
+        self.process = process
+        self.path = path
+        self.secret = secret
+        self.workers = workers
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(queue_size)
+        self._threads: List[threading.Thread] = []
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+
+    @property
+    def address(self) -> Any:
+        return self._httpd.server_address
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def serve_forever(self) -> None:
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"webhook-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info("Webhook server listening on %s:%s%s", *self.address[:2], self.path)
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads.clear()
+
+    def shutdown(self) -> None:
+        """Stop accepting updates; ``serve_forever`` returns once queued ones are done."""
+        self._httpd.shutdown()
+
+    def _work(self) -> None:
+        while True:
+            update = self._queue.get()
+            if update is None:
+                return
+            try:
+                self.process(update)
+            except Exception:
+                logger.exception("Failed to process update %s", update.get("update_id"))
+
+    def _accept(self, headers: Any, body: bytes) -> int:
+        if self.secret is not None:
+            token = headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(token.encode(), self.secret.encode()):
+                return 403
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return 400
+        if not isinstance(update, dict) or "update_id" not in update:
+            return 400
+        try:
+            self._queue.put_nowait(update)
+        except queue.Full:
+            logger.warning("Webhook queue full, rejecting update %s", update["update_id"])
+            return 503
+        return 200
+
+    def _handler_class(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                if self.path != server.path:
+                    self._reply(404)
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    self._reply(400)
+                    return
+                if length > MAX_BODY:
+                    self.close_connection = True
+                    self._reply(413)
+                    return
+                self._reply(server._accept(self.headers, self.rfile.read(length)))
+
+            def _reply(self, status: int) -> None:
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format: str, *args: Any) -> None:
+                logger.debug(format, *args)
+
+        return Handler
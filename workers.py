@@ -0,0 +1,284 @@
+"""Multi-process runtime: ``python workers.py``.
+
+One front process receives updates (long polling, or the webhook server
+with ``BOT_MODE=webhook``) and hands them to ``BOT_WORKERS`` worker
+processes, each running the handlers from ``bot.py`` in its own
+interpreter. Updates are routed by user id, so one user's updates are
+always handled by the same worker, in the order they arrived: carts,
+click coalescing and checkout state never race between processes. All
+workers share the SQLite database, which already serialises writers
+(WAL, ``BEGIN IMMEDIATE`` checkouts, catalog version polling).
+"""
+import logging
+import multiprocessing
+import os
+import queue as queue_module
+import signal
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from telebot import apihelper
+
+import bot as handlers
+import db
+import webhook
+
+
+logger = logging.getLogger(__name__)
+
+BOT_WORKERS = int(os.getenv("BOT_WORKERS") or os.cpu_count() or 1)
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "1000"))
+# Update ids remembered to drop redeliveries.
+DEDUP_SIZE = 10000
+POLL_TIMEOUT = 10
+SHUTDOWN_TIMEOUT = 15.0
+SUPERVISE_INTERVAL = 1.0
+# How often idle workers check whether they should stop.
+POLL_INTERVAL = 1.0
+
+# Processes are spawned, not forked: a fork would copy the front process's
+# threads, locks and SQLite connections in whatever state they are.
+_context = multiprocessing.get_context("spawn")
+
+
+def route_key(update: Dict[str, Any]) -> int:
+    """The id of the user an update belongs to (the chat for channel posts)."""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return update.get("update_id", 0)
+
+
+class RecentIds:
+    """The last ``size`` update ids seen."""
+
+    def __init__(self, size: int = DEDUP_SIZE) -> None:
+        self.size = size
+        self._ids: "OrderedDict[int, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, update_id: int) -> bool:
+        """Remember ``update_id``; False if it was already seen."""
+        with self._lock:
+            if update_id in self._ids:
+                return False
+            self._ids[update_id] = None
+            if len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+            return True
+
+
+def _forward_digests(digests: Any) -> None:
+    """Send this worker's digest notifications to the worker that owns them."""
+    submit = handlers.notifier.submit
+
+    def forward(text: str, digest: bool = False) -> None:
+        if not digest:
+            submit(text)
+            return
+        try:
+            digests.put_nowait(text)
+        except queue_module.Full:
+            handlers.notifier.dropped += 1
+
+    handlers.notifier.submit = forward  # type: ignore[assignment]
+
+
+def _collect_digests(digests: Any, stop: threading.Event) -> None:
+    while not stop.is_set():
+        try:
+            text = digests.get(timeout=POLL_INTERVAL)
+        except queue_module.Empty:
+            continue
+        handlers.notifier.submit(text, digest=True)
+
+
+def _worker_main(index: int, workers: int, updates: Any, digests: Any) -> None:
+    # Ctrl+C reaches the whole process group; the front process stops the
+    # workers itself, with a sentinel after the last update it hands over.
+    # SIGTERM, or losing the front process, stops the worker once its queue
+    # is drained.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    parent = multiprocessing.parent_process()
+    handlers.bot.threaded = False
+    # Only this worker's users; the others' states belong to their workers.
+    handlers.user_states.partition = (index, workers)
+    if handlers.METRICS_PORT:
+        handlers.METRICS_PORT += index
+    metrics_server = handlers.setup_metrics()
+    if handlers.CART_WRITE_BEHIND:
+        db.enable_cart_write_behind(handlers.DB_PATH, handlers.CART_FLUSH_MS / 1000, handlers.CART_FLUSH_OPS)
+    # Admins get one digest per interval, and broadcasts stay within one
+    # rate limit: worker 0 sends both for everyone. Broadcasts started in
+    # other workers are only stored; worker 0 picks them up (and those left
+    # over from the last run) from the database.
+    if index == 0:
+        threading.Thread(target=_collect_digests, args=(digests, stop), name="digests", daemon=True).start()
+        handlers.broadcaster.resume()
+        threading.Thread(target=handlers.broadcaster.watch, args=(stop,), name="broadcasts", daemon=True).start()
+    else:
+        _forward_digests(digests)
+        handlers.broadcaster.run_jobs = False
+    try:
+        while True:
+            try:
+                update = updates.get(timeout=POLL_INTERVAL)
+            except queue_module.Empty:
+                if stop.is_set() or (parent is not None and not parent.is_alive()):
+                    break
+                continue
+            if update is None:
+                break
+            try:
+                handlers.process_update(update)
+            except Exception:
+                logger.exception("Worker %d failed on update %s", index, update.get("update_id"))
+    finally:
+        stop.set()
+        handlers.broadcaster.stop()
+        handlers.clicks.join(timeout=5.0)
+        handlers.notifier.stop()
+        db.disable_cart_write_behind(handlers.DB_PATH)
+        db.close_connections()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+
+class WorkerPool:
+    """``workers`` processes with one bounded queue each.
+
+    :meth:`submit` drops updates whose id was seen recently and puts the
+    rest on the queue of worker ``route_key(update) % workers``, blocking
+    while that queue is full. Workers that die are restarted on the same
+    queue. :meth:`stop` lets every worker finish its queue and shut down.
+    """
+
+    def __init__(self, workers: int = BOT_WORKERS, queue_size: int = WORKER_QUEUE_SIZE) -> None:
+        self.workers = max(1, workers)
+        self.queues = [_context.Queue(queue_size) for _ in range(self.workers)]
+        self.digests = _context.Queue(handlers.NOTIFY_QUEUE_SIZE)
+        self.processes: List[Optional[Any]] = [None] * self.workers
+        self.seen = RecentIds()
+        self.duplicates = 0
+        self._stopping = threading.Event()
+        self._supervisor: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            self._spawn(index)
+        self._supervisor = threading.Thread(target=self._supervise, name="supervisor", daemon=True)
+        self._supervisor.start()
+
+    def submit(self, update: Dict[str, Any]) -> None:
+        update_id = update.get("update_id")
+        if update_id is not None and not self.seen.add(update_id):
+            self.duplicates += 1
+            return
+        self.queues[route_key(update) % self.workers].put(update)
+
+    def stop(self, timeout: float = SHUTDOWN_TIMEOUT) -> None:
+        self._stopping.set()
+        for queue in self.queues:
+            queue.put(None)
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning("Worker %d did not stop in %.0f s, killing it", index, timeout)
+                process.kill()
+                process.join()
+
+    def _spawn(self, index: int) -> None:
+        process = _context.Process(
+            target=_worker_main,
+            args=(index, self.workers, self.queues[index], self.digests),
+            name=f"bot-worker-{index}",
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info("Worker %d started (pid %d)", index, process.pid)
+
+    def _supervise(self) -> None:
+        while not self._stopping.wait(SUPERVISE_INTERVAL):
+            for index, process in enumerate(self.processes):
+                if process is not None and not process.is_alive() and not self._stopping.is_set():
+                    logger.error("Worker %d exited with %s, restarting", index, process.exitcode)
+                    self._spawn(index)
+
+
+def poll(pool: WorkerPool, stop: threading.Event) -> None:
+    """Long-poll getUpdates and submit every update until ``stop`` is set."""
+    offset = None
+    while not stop.is_set():
+        try:
+            updates = apihelper.get_updates(
+                handlers.BOT_TOKEN, offset=offset, timeout=POLL_TIMEOUT + 5, long_polling_timeout=POLL_TIMEOUT
+            )
+        except Exception:
+            logger.exception("getUpdates failed")
+            stop.wait(3)
+            continue
+        for update in updates:
+            offset = update["update_id"] + 1
+            pool.submit(update)
+
+
+def serve_webhook(pool: WorkerPool) -> webhook.WebhookServer:
+    # A single thread hands updates over, so they reach the worker queues
+    # in the order Telegram sent them.
+    webhook.check_secret(handlers.WEBHOOK_SECRET, handlers.WEBHOOK_HOST, handlers.WEBHOOK_URL)
+    server = webhook.WebhookServer(
+        pool.submit,
+        host=handlers.WEBHOOK_HOST,
+        port=handlers.WEBHOOK_PORT,
+        path=handlers.WEBHOOK_PATH,
+        secret=handlers.WEBHOOK_SECRET,
+        workers=1,
+        queue_size=handlers.WEBHOOK_QUEUE_SIZE,
+    )
+    if handlers.WEBHOOK_URL:
+        handlers.bot.remove_webhook()
+        handlers.bot.set_webhook(url=handlers.WEBHOOK_URL, secret_token=handlers.WEBHOOK_SECRET)
+    return server
+
+
+def main() -> None:
+    # Migrate once here rather than in every worker at the same time.
+    db.init_db(handlers.DB_PATH)
+    db.close_connections()
+    pool = WorkerPool()
+    pool.start()
+    stop = threading.Event()
+    server = serve_webhook(pool) if handlers.BOT_MODE == "webhook" else None
+
+    def shutdown(signum: int, frame: Any) -> None:
+        logger.info("Signal %d received, shutting down", signum)
+        stop.set()
+        if server is not None:
+            # shutdown() waits for serve_forever, which runs in this thread.
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    try:
+        if server is not None:
+            server.serve_forever()
+        else:
+            poll(pool, stop)
+    finally:
+        pool.stop()
+        logger.info("Stopped; %d duplicate updates dropped", pool.duplicates)
+
+
+if __name__ == "__main__":
+    main()